@@ -1,3 +1,26 @@
-"""Restler, the RESTful base controller for Pylons."""
-from restler.controller import Controller
+"""Restler, the RESTful base controller for Pylons.
+
+The Pylons adapter, :class:`Controller`, is imported on first access so that
+importing :mod:`restler.entity` or :mod:`restler.core` doesn't import Pylons.
+
+"""
+import sys
+
 from restler.entity import Entity, instrument_class
+
+
+def __getattr__(name):
+    if name == 'Controller':
+        from restler.controller import Controller
+        return Controller
+    raise AttributeError(
+        'module {0!r} has no attribute {1!r}'.format(__name__, name))
+
+
+if sys.version_info < (3, 7):
+    # Module __getattr__ isn't supported
+    try:
+        from restler.controller import Controller
+    except ImportError:
+        # Pylons isn't installed; only the core is available
+        pass
@@ -0,0 +1,195 @@
+"""Streaming bulk import of newline-delimited JSON (NDJSON).
+
+Each line of the input is a JSON object that maps attribute names of an
+entity class to values. Lines are read incrementally and inserted in chunks,
+with a commit after each chunk, so memory use doesn't depend on the size of
+the input. Lines longer than a maximum length are skipped (and reported as
+errors) without being read into memory in full.
+
+"""
+import logging
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from sqlalchemy.orm import ColumnProperty, class_mapper
+
+
+log = logging.getLogger(__name__)
+
+BLOCK_SIZE = 64 * 1024
+
+MAX_LINE_LENGTH = 1024 * 1024
+"""Default maximum length of lines (in bytes) for :class:`BulkImport`."""
+
+
+def iter_lines(fp, block_size=BLOCK_SIZE, max_line_length=None):
+    """Yield lines (as bytes, without line endings) read from ``fp``.
+
+    ``fp`` is read in blocks (so this works with file-like objects that
+    don't support `readline`). Lines longer than ``max_line_length`` are
+    discarded as they're read and `None` is yielded in their place.
+
+    """
+    def too_long(line):
+        return max_line_length is not None and len(line) > max_line_length
+    remainder = b''
+    skipping = False
+    while True:
+        block = fp.read(block_size)
+        if not block:
+            break
+        lines = (remainder + block).split(b'\n')
+        remainder = lines.pop()
+        for line in lines:
+            if skipping:
+                # End of a line whose start was discarded
+                skipping = False
+                yield None
+            elif too_long(line):
+                yield None
+            else:
+                yield line.rstrip(b'\r')
+        if too_long(remainder):
+            skipping = True
+            remainder = b''
+    if skipping or too_long(remainder):
+        yield None
+    elif remainder:
+        yield remainder.rstrip(b'\r')
+
+
+class BulkImport(object):
+    """Import members of ``entity`` from NDJSON.
+
+    ``convert`` is called with each attribute name and value to convert the
+    value to the appropriate Python type (typically, this is
+    `Entity.convert_param`).
+
+    ``progress`` is called with the report (see :meth:`get_report`) after
+    each chunk is committed.
+
+    Lines that are longer than ``max_line_length`` or can't be parsed or
+    converted and rows that can't be inserted are skipped; errors for these
+    are included in the report (up to ``max_errors`` of them).
+
+    """
+
+    def __init__(self, session, entity, convert=None, chunk_size=1000,
+                 max_errors=100, progress=None,
+                 max_line_length=MAX_LINE_LENGTH):
+        self.session = session
+        self.entity = entity
+        self.convert = convert or entity.convert_param
+        self.chunk_size = chunk_size
+        self.max_errors = max_errors
+        self.max_line_length = max_line_length
+        self.progress = progress
+        mapper = class_mapper(entity)
+        # Map attribute names to column names
+        self.columns = dict(
+            (p.key, p.columns[0].key) for p in mapper.iterate_properties
+            if isinstance(p, ColumnProperty))
+        self.table = mapper.local_table
+        self.lines = 0
+        self.imported = 0
+        self.failed = 0
+        self.chunks = 0
+        self.errors = []
+
+    def add_error(self, line_number, message):
+        self.failed += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append(dict(line=line_number, error=message))
+
+    def get_report(self):
+        return dict(
+            lines=self.lines,
+            imported=self.imported,
+            failed=self.failed,
+            chunks=self.chunks,
+            errors=self.errors,
+            errors_truncated=(self.failed > len(self.errors)),
+        )
+
+    def convert_record(self, record):
+        if not isinstance(record, dict):
+            raise ValueError('Expected a JSON object')
+        row = {}
+        for name, val in record.items():
+            if name not in self.columns:
+                raise ValueError('Unknown attribute: {0}'.format(name))
+            row[name] = self.convert(name, val)
+        return row
+
+    def run(self, fp):
+        """Import records from NDJSON file-like object ``fp``."""
+        chunk = []
+        lines = iter_lines(fp, max_line_length=self.max_line_length)
+        for line_number, line in enumerate(lines, 1):
+            self.lines = line_number
+            if line is None:
+                self.add_error(
+                    line_number,
+                    'Line is longer than {0} bytes'.format(
+                        self.max_line_length))
+                continue
+            if not line.strip():
+                continue
+            try:
+                row = self.convert_record(json.loads(line.decode('utf-8')))
+            except Exception as e:
+                # Converters can raise anything (e.g., InvalidOperation for
+                # decimals); this shouldn't abort the whole import
+                self.add_error(line_number, str(e) or e.__class__.__name__)
+                continue
+            chunk.append((line_number, row))
+            if len(chunk) >= self.chunk_size:
+                self.insert_chunk(chunk)
+                chunk = []
+        if chunk:
+            self.insert_chunk(chunk)
+        return self.get_report()
+
+    def _insert(self, rows):
+        bulk_insert_mappings = getattr(
+            self.session, 'bulk_insert_mappings', None)
+        if bulk_insert_mappings is not None:
+            bulk_insert_mappings(self.entity, rows)
+        else:
+            # SQLAlchemy < 1.0; executemany with column names as keys
+            rows = [
+                dict((self.columns[k], v) for (k, v) in row.items())
+                for row in rows]
+            self.session.execute(self.table.insert(), rows)
+        self.session.commit()
+
+    def insert_chunk(self, chunk):
+        """Insert ``chunk`` of (line number, row) and commit.
+
+        If the chunk can't be inserted, its rows are inserted one at a time
+        so that the rows that caused the error can be reported.
+
+        """
+        try:
+            self._insert([row for (line_number, row) in chunk])
+        except Exception as e:
+            self.session.rollback()
+            log.debug('Could not insert chunk (%s); retrying row by row' % e)
+            for line_number, row in chunk:
+                try:
+                    self._insert([row])
+                except Exception as e:
+                    self.session.rollback()
+                    # Use the DBAPI error, if available, for a concise message
+                    self.add_error(line_number, str(getattr(e, 'orig', e)))
+                else:
+                    self.imported += 1
+        else:
+            self.imported += len(chunk)
+        self.chunks += 1
+        log.info('Imported %s of %s lines into %s' % (
+            self.imported, self.lines, self.table.name))
+        if self.progress is not None:
+            self.progress(self.get_report())
@@ -0,0 +1,91 @@
+"""Single-flight coalescing of identical concurrent requests.
+
+When several threads ask for the same thing at the same time, only the first
+(the "leader") does the work; the others wait for the leader to finish and
+share its result (or its exception).
+
+"""
+import logging
+import sys
+import threading
+
+
+log = logging.getLogger(__name__)
+
+
+class CoalesceTimeout(Exception):
+    """Raised when waiting on an in-flight call takes too long."""
+
+
+class _Call(object):
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.exc_info = None
+        self.waiters = 0
+
+
+class SingleFlight(object):
+    """Group of in-flight calls keyed by an arbitrary hashable key.
+
+    Instances are thread-safe and are meant to be shared by all threads in
+    a process.
+
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func, timeout=None):
+        """Call ``func`` unless an identical call is already in flight.
+
+        Returns a 2-tuple: the result of ``func`` and a flag indicating
+        whether the result was shared (i.e., whether this thread waited on
+        another thread's call instead of calling ``func`` itself).
+
+        If ``func`` raises, the exception is re-raised in the leader *and* in
+        every waiting thread.
+
+        If ``timeout`` (seconds) is given and the in-flight call doesn't
+        finish in time, :class:`CoalesceTimeout` is raised in the waiting
+        thread. The in-flight call is not affected.
+
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = _Call()
+                leader = True
+            else:
+                call.waiters += 1
+                leader = False
+
+        if leader:
+            try:
+                call.result = func()
+            except BaseException:
+                call.exc_info = sys.exc_info()
+                raise
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.event.set()
+                if call.waiters:
+                    log.debug('Shared result with %s waiter(s): %r' %
+                              (call.waiters, key))
+            return call.result, False
+
+        call.event.wait(timeout)
+        if not call.event.is_set():
+            raise CoalesceTimeout(
+                'Timed out after {0}s waiting on {1!r}'.format(timeout, key))
+        if call.exc_info is not None:
+            raise call.exc_info[1]
+        return call.result, True
+
+    def in_flight(self):
+        """Return the number of calls currently in flight."""
+        with self._lock:
+            return len(self._calls)
@@ -0,0 +1,1451 @@
+"""Framework-neutral RESTful resources.
+
+:class:`Resource` implements the RESTful actions (`index`, `show`, `new`,
+`edit`, `create`, `update`, and `delete`) along with filtering,
+serialization, and redirects. It works on a WebOb request that's passed to
+it explicitly, so it doesn't depend on any particular Web framework (or on
+thread-local proxies to get at the current request).
+
+:class:`ResourceApp` is a WSGI app that routes requests to resources (see
+:func:`route`)::
+
+    class ThingResource(Resource):
+
+        entity = Thing
+
+        def get_db_session(self):
+            return Session
+
+    app = ResourceApp(ThingResource)
+
+:class:`restler.Controller` adapts :class:`Resource` to Pylons.
+
+"""
+import hashlib
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+try:
+    from urllib import quote, urlencode
+except ImportError:
+    # Python 3
+    from urllib.parse import quote, urlencode
+
+from webob import Request, Response
+from webob.exc import HTTPException, HTTPNotFound, status_map
+
+from sqlalchemy.orm import class_mapper
+
+from restler import msgpack_ext
+from restler.bulk import MAX_LINE_LENGTH, BulkImport
+from restler.coalesce import CoalesceTimeout, SingleFlight
+from restler.embed import embed_related, parse_embed
+from restler.entity import _native_kwargs, string_types
+from restler.pool import get_pool_metrics, prewarm
+from restler.profiler import RequestProfiler
+from restler.snapshot import (
+    discard_snapshot, find_snapshots, get_changed_at, get_snapshot,
+    mark_changed)
+from restler.sync import (
+    INITIAL_TOKEN, after_key, decode_token, encode_token,
+    get_latest_tombstone_id, get_tombstones, next_sync_value,
+    record_tombstone)
+from restler.timeout import StatementTimeout, StatementTimeoutError
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+
+log = logging.getLogger(__name__)
+
+_flights = SingleFlight()
+
+
+class NoDefaultValue(object):
+
+    def __new__(self, *args, **kwargs):
+        raise NotImplementedError('This class may not be instantiated.')
+
+
+def asbool(obj):
+    """Convert config/param value ``obj`` to a `bool`."""
+    if isinstance(obj, string_types):
+        value = obj.strip().lower()
+        if value in ('true', 'yes', 'on', 'y', 't', '1'):
+            return True
+        elif value in ('false', 'no', 'off', 'n', 'f', '0'):
+            return False
+        raise ValueError('String is not true/false: %r' % obj)
+    return bool(obj)
+
+
+def aslist(obj, sep=None, strip=True):
+    """Convert config/param value ``obj`` to a `list`."""
+    if isinstance(obj, string_types):
+        items = obj.split(sep)
+        if strip:
+            items = [item.strip() for item in items]
+        return items
+    elif isinstance(obj, (list, tuple)):
+        return list(obj)
+    elif obj is None:
+        return []
+    return [obj]
+
+
+def route(request, collection_name, collection_actions=None):
+    """Map ``request`` to a RESTful action on ``collection_name``.
+
+    Returns (action, id, format) or `None` if the request doesn't map to an
+    action. The collection is matched at the end of the path, so it can be
+    mounted anywhere::
+
+        GET     /things                 index
+        POST    /things                 create
+        GET     /things/new             new
+        GET     /things/{id}            show
+        PUT     /things/{id}            update
+        DELETE  /things/{id}            delete
+        GET     /things/{id}/edit       edit
+
+    Any of these paths may end with a format extension (e.g., `.json`). As
+    with Routes, a `_method` param can be used to make a POST request act
+    like a PUT or DELETE. ``collection_actions`` maps the names of extra
+    collection actions to their methods (e.g., ``{'bulk_import': 'POST'}``).
+
+    """
+    segments = request.path_info.rstrip('/').split('/')
+    format = None
+    if '.' in segments[-1]:
+        segments[-1], format = segments[-1].rsplit('.', 1)
+    method = request.method
+    if method == 'POST':
+        method = request.params.get('_method', method).upper()
+    if segments[-1] == collection_name:
+        actions = dict(GET='index', POST='create')
+        id = None
+    elif len(segments) > 1 and segments[-2] == collection_name:
+        id = segments[-1]
+        if id == 'new':
+            actions = dict(GET='new')
+            id = None
+        elif (collection_actions or {}).get(id) == method:
+            return id, None, format
+        else:
+            actions = dict(GET='show', PUT='update', DELETE='delete')
+    elif (len(segments) > 2 and segments[-3] == collection_name and
+            segments[-1] == 'edit'):
+        actions = dict(GET='edit')
+        id = segments[-2]
+    else:
+        return None
+    action = actions.get(method)
+    if action is None:
+        return None
+    return action, id, format
+
+
+class ResourceApp(object):
+    """WSGI app that routes requests to :class:`Resource` subclasses."""
+
+    def __init__(self, *resource_classes):
+        self.resource_classes = resource_classes
+
+    def __call__(self, environ, start_response):
+        for resource_class in self.resource_classes:
+            request = resource_class.request_class(environ)
+            match = route(
+                request, resource_class.entity.collection_name,
+                resource_class.collection_actions)
+            if match is not None:
+                action, id, format = match
+                resource = resource_class(request)
+                response = resource.dispatch(action, id, format)
+                break
+        else:
+            response = HTTPNotFound()
+        return response(environ, start_response)
+
+
+class Resource(object):
+
+    entity = None
+    """Entity class associated with this resource."""
+
+    base_filter_params = dict(
+        where_clause=NoDefaultValue,  # Any valid SQL where clause fragment
+        distinct=False,
+        offset=None,
+        start=None,
+        limit=None,
+        order_by=None,
+        changed_since=NoDefaultValue,  # Sync token; see restler.sync
+    )
+
+    filter_params = {}
+    """Request param names with defaults, for filtering collections."""
+
+    filters = []
+    """SQLAlchemy filters--anything that can be an arg to `query().filter`.
+
+    These filters are *not* request-specific--they are applied on *every*
+    request.
+
+    """
+
+    default_format = 'json'
+
+    default_limit = None
+    """Limit applied to collections when the `limit` param isn't passed.
+
+    If this isn't set, `max_limit` is used instead.
+
+    """
+
+    max_limit = None
+    """Maximum value allowed for the `limit` param (larger values are a 400)."""
+
+    statement_timeout = None
+    """Seconds after which queries for collections and members are cancelled.
+
+    Requests that time out get a 503 response. See :mod:`restler.timeout`.
+
+    """
+
+    max_response_size = None
+    """Maximum size of rendered responses in bytes (larger are a 400)."""
+
+    embeddable = None
+    """Relationships that can be embedded via the `embed` param.
+
+    Names of nested relationships are dotted (e.g., `stops.times`). If this
+    isn't set, any relationship can be embedded. See :mod:`restler.embed`.
+
+    """
+
+    max_embed_depth = 2
+    """Maximum nesting depth of embedded relationships (deeper is a 400)."""
+
+    default_embed_limit = None
+    """Limit applied to embedded relationships that don't specify one.
+
+    If this isn't set, `max_embed_limit` is used instead.
+
+    """
+
+    max_embed_limit = None
+    """Maximum `limit` allowed for embedded relationships."""
+
+    snapshot_dir = None
+    """Directory to store snapshots of the default `index` response in.
+
+    When this and `snapshot_origins` are set, `index` requests with no
+    params (other than the format in the URL) are served from a precomputed
+    snapshot of the response; see :mod:`restler.snapshot`. Snapshots are
+    rebuilt in the background after `create`, `update`, and `delete` and
+    when they're older than `snapshot_max_age`.
+
+    """
+
+    snapshot_origins = None
+    """Origins (like `request.host_url`) whose requests use snapshots.
+
+    Responses contain URLs, so there's a snapshot per origin. The origin
+    comes from the client's Host header, so only those listed here (e.g.,
+    ``['https://example.com']``) get snapshots; requests to other origins
+    are handled normally.
+
+    """
+
+    snapshot_max_age = None
+    """Seconds after which snapshots are rebuilt (never if not set)."""
+
+    import_chunk_size = 1000
+    """Number of rows inserted per transaction by :meth:`bulk_import`."""
+
+    import_max_errors = 100
+    """Maximum number of errors reported by :meth:`bulk_import`."""
+
+    import_max_line_length = MAX_LINE_LENGTH
+    """Maximum length in bytes of lines imported by :meth:`bulk_import`."""
+
+    import_content_types = ('application/x-ndjson', 'application/json-seq',
+                            'application/jsonlines', 'text/plain')
+    """Content types accepted by :meth:`bulk_import`."""
+
+    tombstone_table = None
+    """Table that deletes are recorded in for incremental sync.
+
+    See :func:`restler.sync.make_tombstone_table`. If this isn't set, deletes
+    won't be reported to clients doing incremental syncs.
+
+    """
+
+    sync_counter_table = None
+    """Table used to assign values of the entity's sync column.
+
+    See :func:`restler.sync.make_sync_counter_table`. When this is set,
+    `create` and `update` set the sync column of the member to the next
+    value for the collection, and `delete` takes the collection's counter
+    lock before recording a tombstone. This ensures values are committed in
+    the order they're assigned, which incremental sync relies on.
+
+    """
+
+    sync = None
+    """Sync token and deleted IDs when `changed_since` was passed."""
+
+    coalesce = False
+    """Coalesce identical concurrent GET requests to `index` and `show`.
+
+    When set, concurrent requests with the same key (see
+    :meth:`get_coalesce_key`) wait on a single in-flight computation and
+    share its rendered result. Only enable this for resources whose output
+    depends only on that key (e.g., not on the current user).
+
+    """
+
+    coalesce_timeout = 30
+    """Seconds to wait on an in-flight request before doing the work anyway."""
+
+    coalesce_headers = ('Content-Type', 'X-Restler-Sync-Token')
+    """Response headers copied from an in-flight request to its waiters.
+
+    Other headers (e.g., `Set-Cookie`) may be specific to the request that
+    set them, so they aren't shared.
+
+    """
+
+    pool_metrics = False
+    """Collect metrics for the entity's connection pool; see `restler.pool`."""
+
+    pool_prewarm_connections = 0
+    """Default number of connections opened by :meth:`prewarm_pool`."""
+
+    profile_dir = None
+    """Directory to write profiling reports to; profiling is off if not set."""
+
+    profile_sample_rate = 0
+    """Fraction of requests to profile (0 to 1) when `profile_dir` is set."""
+
+    profile_repeat_threshold = 3
+    """Statements executed at least this many times are flagged in reports."""
+
+    collection_actions = {}
+    """Additional collection actions, mapped to their HTTP methods.
+
+    This is used by :func:`route` (like the `collection` arg of Routes'
+    `map.resource`). For example, ``{'bulk_import': 'POST'}``.
+
+    """
+
+    request_class = Request
+    response_class = Response
+
+    def __init__(self, request=None):
+        if request is not None:
+            self.request = request
+            self.response = self.response_class()
+
+    def dispatch(self, action, id=None, format=None):
+        """Call ``action`` and return the response.
+
+        ``id`` is passed to member actions. HTTP errors raised by the action
+        (via :meth:`abort` or :meth:`redirect`) are returned as the response.
+
+        """
+        def call():
+            self._setup(action, format)
+            args = () if id is None else (id,)
+            return getattr(self, action)(*args)
+        try:
+            body = self._handle(call)
+        except HTTPException as e:
+            return e
+        response = self.response
+        if body is None:
+            pass
+        elif isinstance(body, bytes):
+            response.body = body
+        elif isinstance(body, string_types):
+            response.text = body
+        else:
+            response.app_iter = body
+        return response
+
+    def _handle(self, call):
+        """Call ``call`` (profiling it if sampled) and clear the DB session."""
+        try:
+            profiler = self._start_profiler()
+            if profiler is None:
+                return call()
+            try:
+                return call()
+            finally:
+                self._stop_profiler(profiler)
+        finally:
+            log.debug('Clearing database session...')
+            self.clear_db_session()
+
+    def _setup(self, action, format=None, controller=None):
+        """Set up for handling ``action``; called before every action.
+
+        ``format`` defaults to the `format` request param and then
+        `default_format`. ``controller`` is the name used to find templates
+        and build URLs; it defaults to the entity's collection name.
+
+        """
+        bind = self.db_session.get_bind(class_mapper(self.entity))
+        if self.pool_metrics:
+            get_pool_metrics(getattr(bind, 'engine', bind))
+        if controller is None:
+            controller = self.entity.collection_name
+        self.controller = controller
+        self.action = action
+        self.member_name = self.entity.member_name
+        self.member_title = self.entity.member_title
+        self.collection_name = self.entity.collection_name
+        self.collection_title = self.entity.collection_title
+        if format is None:
+            format = self.request.params.get('format', self.default_format)
+        self.format = format
+        self._init_properties()
+        log.debug('Action: %s' % self.action)
+
+    def abort(self, code, detail=None):
+        """Abort the current request with HTTP error ``code``."""
+        raise status_map[code](detail=detail)
+
+    def redirect(self, url, code=303):
+        """Redirect to ``url`` (with a 303 See Other by default)."""
+        raise status_map[code](location=url)
+
+    def url_for(self, **url_args):
+        """Get URL path for a member or collection action.
+
+        ``url_args`` are the same as for Routes' `url` as used by
+        :meth:`_do_redirect`: `action`, `id`, and `format`; any others are
+        added to the query string. The path includes the application prefix.
+
+        """
+        url_args = dict(url_args)
+        url_args.pop('controller', None)
+        action = url_args.pop('action', 'index')
+        id = url_args.pop('id', None)
+        format = url_args.pop('format', None)
+        path = self.collection_path
+        if id is not None:
+            path = '{0}/{1}'.format(path, quote(str(id), safe=''))
+        if action in ('new', 'edit'):
+            path = '{0}/{1}'.format(path, action)
+        if format:
+            path = '{0}.{1}'.format(path, format)
+        if url_args:
+            path = '{0}?{1}'.format(path, urlencode(sorted(url_args.items())))
+        return path
+
+    @classmethod
+    def prewarm_pool(cls, connections=None):
+        """Open connections in the pool for `entity`'s bind ahead of time.
+
+        This is intended to be called at application startup (once for each
+        resource) so that the first requests don't pay for connection
+        establishment. ``connections`` defaults to
+        `pool_prewarm_connections`. Returns the number of connections opened.
+
+        """
+        if connections is None:
+            connections = cls.pool_prewarm_connections
+        resource = cls()
+        try:
+            bind = resource.db_session.get_bind(class_mapper(cls.entity))
+            engine = getattr(bind, 'engine', bind)
+            if cls.pool_metrics:
+                get_pool_metrics(engine)
+            return prewarm(engine, connections)
+        finally:
+            resource.clear_db_session()
+
+    def _get_profiler(self):
+        """Return a :class:`RequestProfiler` if this request is sampled."""
+        if not self.profile_dir or random.random() >= self.profile_sample_rate:
+            return None
+        bind = self.db_session.get_bind(class_mapper(self.entity))
+        engine = getattr(bind, 'engine', bind)
+        return RequestProfiler(
+            engines=[engine], repeat_threshold=self.profile_repeat_threshold)
+
+    def _start_profiler(self):
+        """Start profiling if this request is sampled.
+
+        Returns the profiler, or `None` if the request isn't sampled or
+        another request is already being profiled. Profiler errors are
+        logged rather than failing the request.
+
+        """
+        try:
+            profiler = self._get_profiler()
+            if profiler is not None and profiler.start():
+                return profiler
+        except Exception:
+            log.exception('Could not start profiler')
+        return None
+
+    def _stop_profiler(self, profiler):
+        try:
+            profiler.stop()
+            self._write_profile(profiler)
+        except Exception:
+            log.exception('Could not stop profiler or write its report')
+
+    def _write_profile(self, profiler):
+        controller = self.__dict__.get('controller', self.__class__.__name__)
+        action = self.__dict__.get('action', 'unknown')
+        # The random part keeps reports for requests made in the same second
+        # from overwriting each other
+        name = '{0}-{1}-{2}-{3}-{4}-{5}'.format(
+            time.strftime('%Y%m%d%H%M%S'), os.getpid(),
+            threading.current_thread().ident, controller, action,
+            uuid.uuid4().hex[:8])
+        title = '{0} {1}'.format(self.request.method, self.request.url)
+        try:
+            fields = self.fields
+        except ValueError:
+            fields = None
+        try:
+            path = profiler.write_report(
+                self.profile_dir, name, title=title, fields=fields)
+        except (IOError, OSError) as e:
+            log.error('Could not write profile report: %s' % e)
+        else:
+            log.info('Wrote profile report to %s' % path)
+
+    def _get_db_session(self):
+        """Database session factory.
+
+        The default implementation here assumes that subclasses have a public
+        :meth:`get_db_session` method. The session returned from that method
+        is cached per :class:`Resource` instance.
+
+        """
+        try:
+            self._db_session
+        except AttributeError:
+            self._db_session = self.get_db_session()
+        return self._db_session
+    def _set_db_session(self, db_session):
+        self._db_session = db_session
+    db_session = property(_get_db_session, _set_db_session)
+
+    def get_db_session(self):
+        raise NotImplementedError
+
+    def clear_db_session(self):
+        self.db_session.remove()
+
+    @property
+    def collection_path(self):
+        """Path to collection, including application path prefix."""
+        try:
+            self._collection_path
+        except AttributeError:
+            path = self.request.path
+            self._collection_path = '/'.join((
+                path.rsplit(self.collection_name, 1)[0].rstrip('/'),
+                self.collection_name))
+        return self._collection_path
+
+    def get_member_path(self, member):
+        """Path to member, including application path prefix."""
+        id = getattr(member, 'id_str', None)
+        return '{0}/{1}'.format(self.collection_path, id)
+
+    def get_member_paths(self, members):
+        """Paths to ``members``; like :meth:`get_member_path`, in bulk.
+
+        The collection prefix is computed once, and IDs are converted with
+        `Entity.ids_to_str`. If :meth:`get_member_path` is overridden, it's
+        used for each member instead.
+
+        """
+        get_member_path = self.get_member_path
+        if (get_member_path.__func__ is not
+                Resource.__dict__['get_member_path'] or
+                not members or not hasattr(members[0], 'ids_to_str')):
+            return [get_member_path(member) for member in members]
+        prefix = self.collection_path + '/'
+        # id_str may be overridden to return something other than a string
+        return [
+            '{0}{1}'.format(prefix, id)
+            for id in self.entity.ids_to_str(members)]
+
+    def index(self):
+        def action():
+            self.set_collection()
+            return self._render()
+        if (self.snapshot_dir is not None and self.request.method == 'GET' and
+                not self.request.params and
+                self.request.host_url in (self.snapshot_origins or ())):
+            return self._serve_snapshot(action)
+        return self._coalesce(action)
+
+    def show(self, id):
+        def action():
+            self.set_member(id)
+            return self._render()
+        return self._coalesce(action, id)
+
+    def new(self):
+        self.set_member()
+        return self._render()
+
+    def edit(self, id):
+        self.set_member(id)
+        return self._render()
+
+    def create(self):
+        self.set_member()
+        self._update_member_with_params()
+        self._set_sync_value()
+        self.db_session.add(self.member)
+        self.db_session.flush()
+        self.db_session.commit()
+        self._rebuild_snapshots()
+        self._redirect_to_member()
+
+    def update(self, id):
+        self.set_member(id)
+        self._update_member_with_params()
+        self._set_sync_value()
+        self.db_session.flush()
+        self.db_session.commit()
+        self._rebuild_snapshots()
+        self._redirect_to_member()
+
+    def delete(self, id):
+        self.set_member(id)
+        if self.tombstone_table is not None:
+            if self.sync_counter_table is not None:
+                # Take the counter lock so tombstone IDs are committed in order
+                next_sync_value(
+                    self.db_session, self.sync_counter_table,
+                    self.collection_name)
+            record_tombstone(
+                self.db_session, self.tombstone_table, self.collection_name,
+                self.member.id_str)
+        self.db_session.delete(self.member)
+        self.db_session.flush()
+        self.db_session.commit()
+        self._rebuild_snapshots()
+        self._redirect_to_collection()
+
+    def get_coalesce_key(self, id=None):
+        """Return key used to coalesce identical concurrent requests.
+
+        Two requests with the same key are assumed to produce identical
+        responses. Subclasses whose responses depend on anything else (an
+        auth header, say) should extend the key.
+
+        """
+        params = tuple(sorted(self.request.params.items()))
+        return (self.__class__, self.entity, self.action, id, self.format,
+                self.request.host_url, self.request.path, params)
+
+    def _coalesce(self, action, id=None):
+        """Call ``action``, sharing its result with identical requests.
+
+        ``action`` must return the response body as a string. When another
+        thread is already handling an identical request, we wait for it and
+        return its status, body, and the headers in `coalesce_headers`
+        instead of calling ``action``. Errors (including HTTP errors such as
+        404s) raised in the in-flight request are raised here too.
+
+        """
+        if not self.coalesce or self.request.method != 'GET':
+            return action()
+        def compute():
+            body = action()
+            names = set(name.lower() for name in self.coalesce_headers)
+            headers = [
+                (name, value) for (name, value) in self.response.headerlist
+                if name.lower() in names]
+            return self.response.status, headers, body
+        key = self.get_coalesce_key(id)
+        try:
+            result, shared = _flights.do(key, compute, self.coalesce_timeout)
+        except CoalesceTimeout as e:
+            log.warning('%s; handling request without coalescing' % e)
+            return action()
+        status, headers, body = result
+        if shared:
+            log.debug('Using coalesced result for %r' % (key,))
+            self.response.status = status
+            for name in self.coalesce_headers:
+                if name in self.response.headers:
+                    del self.response.headers[name]
+            for name, value in headers:
+                self.response.headers.add(name, value)
+        return body
+
+    def _get_snapshot_prefix(self):
+        cls = self.__class__
+        return '{0}.{1}'.format(cls.__module__, cls.__name__)
+
+    def _get_snapshot_name(self):
+        """Get name of snapshot for the current request.
+
+        Responses contain URLs, so there's a snapshot per host and script
+        name as well as per format.
+
+        """
+        origin = self.request.host_url + self.request.script_name
+        origin = hashlib.sha1(origin.encode('utf-8')).hexdigest()[:16]
+        return '{0}.{1}.{2}'.format(
+            self._get_snapshot_prefix(), self.format, origin)
+
+    def _serve_snapshot(self, action):
+        """Serve `index` response from snapshot, building it if necessary.
+
+        The first request in each process builds the snapshot synchronously
+        (by calling ``action``). The environment of that request is saved so
+        that the snapshot can be rebuilt later in a background thread, which
+        happens when it's stale (including when another process changed the
+        underlying data).
+
+        """
+        snapshot = get_snapshot(self.snapshot_dir, self._get_snapshot_name())
+        if snapshot.exists:
+            # It may have been rebuilt or removed by another process
+            snapshot.refresh()
+        if not snapshot.exists:
+            built_at = time.time()
+            try:
+                body = self._coalesce(action)
+            except Exception:
+                # Don't keep snapshots for requests that fail (e.g., for
+                # unknown formats)
+                discard_snapshot(snapshot)
+                raise
+            if not isinstance(body, bytes):
+                body = body.encode(self.response.charset or 'utf-8')
+            snapshot.context = self._get_snapshot_context()
+            snapshot.write(
+                body, self.response.headers.get('Content-Type'), built_at)
+            return body
+        changed_at = get_changed_at(
+            self.snapshot_dir, self._get_snapshot_prefix())
+        if (not snapshot.building and
+                snapshot.is_stale(self.snapshot_max_age, changed_at)):
+            self._rebuild_snapshot(snapshot)
+        if snapshot.content_type is not None:
+            self.response.headers['Content-Type'] = snapshot.content_type
+        return snapshot.serve(self.request.environ)
+
+    def _get_snapshot_context(self):
+        """Get what's needed to render the current request in another thread.
+
+        That's a copy of the WSGI environ (minus the input stream, etc) along
+        with the format and controller name.
+
+        """
+        environ = dict(
+            (k, v) for (k, v) in self.request.environ.items()
+            if isinstance(v, string_types))
+        return dict(
+            environ=environ, format=self.format, controller=self.controller)
+
+    def _rebuild_snapshots(self):
+        """Rebuild snapshots (in all formats) for this resource.
+
+        Other processes pick up the change the next time they serve one of
+        the snapshots.
+
+        """
+        if self.snapshot_dir is None:
+            return
+        prefix = self._get_snapshot_prefix()
+        mark_changed(self.snapshot_dir, prefix)
+        for snapshot in find_snapshots(self.snapshot_dir, prefix + '.'):
+            # Snapshots without a context are still being built for the
+            # first time; they'll be stale once built
+            if snapshot.context is not None:
+                self._rebuild_snapshot(snapshot)
+
+    def _rebuild_snapshot(self, snapshot):
+        snapshot.stale = True
+        context = snapshot.context
+        cls = self.__class__
+        snapshot.rebuild(lambda: cls._build_snapshot(context))
+
+    @classmethod
+    def _build_snapshot(cls, context):
+        """Render default `index` response outside of a request.
+
+        This is called in a background thread with the context saved by
+        :meth:`_get_snapshot_context`.
+
+        """
+        resource = cls(cls.request_class(dict(context['environ'])))
+        return resource._render_snapshot(context)
+
+    def _render_snapshot(self, context):
+        """Render snapshot using ``context``.
+
+        Returns `None` if the request would be an error (e.g., a 404 when
+        the collection is empty), so the snapshot is removed and requests
+        get the error from the regular `index` action.
+
+        """
+        try:
+            self._setup('index', context['format'], context['controller'])
+            try:
+                self.set_collection()
+                body = self._render()
+            except HTTPException as e:
+                log.debug('Not snapshotting %s response' % e.code)
+                return None
+            if not isinstance(body, bytes):
+                body = body.encode(self.response.charset or 'utf-8')
+            return body, self.response.headers.get('Content-Type')
+        finally:
+            self.clear_db_session()
+
+    def bulk_import(self):
+        """Import members from newline-delimited JSON in the request body.
+
+        Each line of the body must be a JSON object mapping attribute names
+        to values. Values are converted with :meth:`convert_param`. Rows are
+        inserted in chunks of `import_chunk_size`, and each chunk is
+        committed separately. The body is read incrementally, so it can be
+        arbitrarily large.
+
+        This isn't one of the standard RESTful actions, so it must be mapped
+        explicitly. For example::
+
+            map.resource('thing', 'things', collection={'bulk_import': 'POST'})
+
+        The response is a JSON report with the number of lines read, the
+        number of rows imported, and any errors (with line numbers).
+
+        """
+        # Bodies with form content types have already been read into memory
+        # (to get the params), so only accept NDJSON-ish content types
+        if self.request.content_type not in self.import_content_types:
+            self.abort(415, 'Content type must be one of: {0}'.format(
+                ', '.join(self.import_content_types)))
+        importer = BulkImport(
+            self.db_session, self.entity, convert=self.convert_param,
+            chunk_size=self.import_chunk_size,
+            max_errors=self.import_max_errors,
+            progress=self.import_progress,
+            max_line_length=self.import_max_line_length)
+        report = importer.run(self.request.body_file)
+        if report['imported']:
+            self._rebuild_snapshots()
+        return self._render_object_as_json(report)
+
+    def import_progress(self, report):
+        """Called by :meth:`bulk_import` after each chunk is committed.
+
+        ``report`` is the same as the report returned by `bulk_import`. The
+        default implementation does nothing; the import progress is logged
+        regardless.
+
+        """
+
+    def set_member(self, id=None):
+        if id is None:
+            member = self.entity()
+        else:
+            member = self.get_entity_or_404(id)
+        self.member = member
+
+    def set_collection(self, q=None, extra_filters=None, filter_params=None):
+        q = q if q is not None else self.db_session.query(self.entity)
+
+        # Apply "global" (i.e., every request) filters
+        filters = (self.filters or []) + (extra_filters or [])
+        for f in filters:
+            q = q.filter(f)
+
+        # Apply per-request filters
+        filters = self._set_filters_from_params(self.base_filter_params)
+        filters.update(self._set_filters_from_params(self.filter_params))
+        if filter_params is not None:
+            filters.update(self._set_filters_from_params(filter_params))
+
+        distinct = asbool(filters.pop('distinct', False))
+        offset = filters.pop('offset', filters.pop('start', None))
+        limit = filters.pop('limit', None)
+        order_by = filters.pop('order_by', None)
+
+        where_clause = filters.pop('where_clause', NoDefaultValue)
+        if where_clause is not NoDefaultValue:
+            q = q.filter(where_clause)
+
+        changed_since = filters.pop('changed_since', NoDefaultValue)
+        if changed_since is not NoDefaultValue:
+            q = self._filter_changed_since(q, changed_since)
+
+        for k, v in filters.items():
+            v = self.convert_param(k, v)
+            filter_method = getattr(self.entity, 'filter_by_%s' % k, None)
+            if filter_method is not None:
+                q = filter_method(q, v)
+            else:
+                q = q.filter_by(**{k: v})
+
+        if distinct:
+            q = q.distinct()
+        if order_by is not None:
+            q = q.order_by(*aslist(order_by, ','))
+        offset = self._get_offset(offset)
+        if offset is not None:
+            q = q.offset(offset)
+        limit = self._get_limit(limit)
+        if limit is not None:
+            q = q.limit(limit)
+
+        with self._statement_timeout():
+            collection = q.all()
+        if changed_since is not NoDefaultValue:
+            # An empty collection just means nothing has changed
+            self._set_sync(collection, changed_since)
+        elif not collection:
+            self.abort(404)
+        self.collection = collection
+
+    def _get_limit(self, limit):
+        """Get limit to apply given ``limit`` param, enforcing `max_limit`."""
+        if limit is None:
+            limit = self.default_limit
+            if limit is None:
+                limit = self.max_limit
+        if limit is None:
+            return None
+        try:
+            limit = int(limit)
+        except ValueError:
+            self.abort(400, 'Limit must be an integer: {0}'.format(limit))
+        if limit < 0:
+            self.abort(400, 'Limit must not be negative: {0}'.format(limit))
+        if self.max_limit is not None and limit > self.max_limit:
+            self.abort(400, 'Limit must be no more than {0}'.format(
+                self.max_limit))
+        return limit
+
+    def _get_offset(self, offset):
+        """Get offset to apply given ``offset`` param."""
+        if offset is None:
+            return None
+        try:
+            offset = int(offset)
+        except ValueError:
+            self.abort(400, 'Offset must be an integer: {0}'.format(offset))
+        if offset < 0:
+            self.abort(400, 'Offset must not be negative: {0}'.format(offset))
+        return offset
+
+    @contextmanager
+    def _statement_timeout(self):
+        """Enforce `statement_timeout` for queries run in this context.
+
+        If a query is cancelled because it took too long, the session is
+        rolled back and the request is aborted with a 503.
+
+        """
+        if self.statement_timeout is None:
+            yield
+            return
+        timeout = StatementTimeout(
+            self.db_session, self.statement_timeout,
+            mapper=class_mapper(self.entity))
+        try:
+            with timeout:
+                yield
+        except StatementTimeoutError as e:
+            log.warning('%s: %s' % (e, self.request.url))
+            self.db_session.rollback()
+            self.abort(503, 'The request took too long to complete')
+
+    def _set_sync_value(self):
+        """Set the member's sync column using `sync_counter_table`."""
+        name = self.entity.sync_column
+        if self.sync_counter_table is None or name is None:
+            return
+        value = next_sync_value(
+            self.db_session, self.sync_counter_table, self.collection_name)
+        setattr(self.member, name, value)
+
+    def _get_sync_column(self):
+        name = self.entity.sync_column
+        if name is None:
+            self.abort(400, 'Incremental sync is not supported for {0}'.format(
+                self.collection_title))
+        return getattr(self.entity, name)
+
+    def _get_sync_key_columns(self):
+        """Get the sync column followed by the primary key columns."""
+        column = self._get_sync_column()
+        return [column] + list(class_mapper(self.entity).primary_key)
+
+    def _filter_changed_since(self, q, token):
+        """Filter ``q`` to members changed since sync ``token``.
+
+        Members are ordered by the entity's sync column and then by primary
+        key, and the token holds those values for the last member synced.
+        This way, when a limit is applied, the next sync picks up exactly
+        where this one left off, even when several members have the same
+        sync column value. The sync column must increase across the whole
+        table whenever a row changes (see :mod:`restler.sync`). Members whose
+        sync column is NULL are excluded.
+
+        """
+        try:
+            key, tombstone_id = decode_token(token)
+        except ValueError as e:
+            self.abort(400, str(e))
+        columns = self._get_sync_key_columns()
+        q = q.filter(columns[0] != None)
+        if key is not None:
+            if len(key) != len(columns):
+                self.abort(400, 'Invalid sync token: {0}'.format(token))
+            q = q.filter(after_key(columns, key))
+        return q.order_by(*columns)
+
+    def _set_sync(self, collection, token):
+        """Set `sync` with a new token and the IDs of deleted members.
+
+        The new token's key is that of the last member in ``collection``,
+        which is ordered by :meth:`_filter_changed_since`. If there are no
+        members, the key from ``token`` is kept.
+
+        """
+        key, tombstone_id = decode_token(token)
+        if collection:
+            member = collection[-1]
+            key = (getattr(member, self.entity.sync_column),)
+            key += tuple(
+                class_mapper(self.entity).primary_key_from_instance(member))
+        deleted = []
+        if self.tombstone_table is not None:
+            if token == INITIAL_TOKEN:
+                # Clients doing their first sync don't have anything to
+                # delete; start from the latest tombstone
+                tombstone_id = get_latest_tombstone_id(
+                    self.db_session, self.tombstone_table, self.collection_name)
+            else:
+                deleted, tombstone_id = get_tombstones(
+                    self.db_session, self.tombstone_table,
+                    self.collection_name, tombstone_id)
+        token = encode_token(key, tombstone_id)
+        self.response.headers['X-Restler-Sync-Token'] = token
+        self.sync = dict(token=token, deleted=deleted)
+
+    def _set_filters_from_params(self, filter_params):
+        filters = {}
+        params = self.request.params
+        for name in filter_params:
+            if name in params:
+                # Get value from request params. If the value is not blank,
+                # that value is used; otherwise, we use the default value.
+                val = params.get(name)
+                if not val:
+                    val = filter_params[name]
+            else:
+                # Param wasn't passed in request params, so use the default
+                # value.
+                val = filter_params[name]
+            if val is not NoDefaultValue:
+                if callable(val):
+                    val = val()
+                filters[name] = val
+        return filters
+
+    def get_entity_or_404(self, id):
+        id = self.entity.str_to_id(id)
+        with self._statement_timeout():
+            entity = self.db_session.query(self.entity).get(id)
+        return entity or self.abort(404)
+
+    def _update_member_with_params(self):
+        params = self.request.params
+        for name in params:
+            val = self.convert_param(name, params[name])
+            setattr(self.member, name, val)
+
+    def convert_param(self, name, val):
+        """Convert param value (string) to Python value."""
+        return self.entity.convert_param(name, val)
+
+    def _do_redirect(self, url_args, redirect_args=None):
+        """Redirect (303 See Other) to a member or collection."""
+        request = self.request
+        url_args.setdefault('controller', self.controller)
+        url_args.setdefault('format', self.format)
+        if redirect_args is None:
+            redirect_args = {}
+        redirect_args.setdefault('code', 303)
+        # X-Restler-Client-Request-URL is the URL used by the client to
+        # make requests to the Web service that is utilizing Restler.
+        # Typically, this would be the (fully qualified) URL of a proxy
+        # server. This is only relevant when using AJAX due to same-origin
+        # restrictions.
+        base_url = request.headers.get('X-Restler-Client-Request-URL')
+        if request.is_xhr and base_url:
+            # For AJAX requests where a "client request URL" has been
+            # specified, we want to prepend that URL instead of using the
+            # URL or path of the WS server.
+            #
+            # `url` will prepend the SCRIPT_NAME for the WS server, which
+            # must be stripped, because we want only the path *within* the
+            # WS server. This is because we have know way of knowing how the
+            # client proxy is mapped to the WS server.
+            redirect_path = self.url_for(**url_args)
+            script_name = request.script_name
+            if script_name and redirect_path.startswith(script_name):
+                redirect_path = redirect_path.replace(script_name, '', 1)
+            redirect_url = base_url.rstrip('/') + redirect_path
+        else:
+            # For non-AJAX requests or requests that don't specify a client
+            # request URL, assume we want to redirect to the same origin that
+            # the original request came from.
+            redirect_url = self.url_for(**url_args)
+        self.redirect(redirect_url, **redirect_args)
+
+    def _redirect_to_member(self, member=None, relay_params=None, params=None):
+        """Redirect to a specific ``member``, defaulting to `self.member`.
+
+        ``relay_params`` List of params to relay from original request. If
+        a param isn't in the original request, it's ignored and not relayed
+        to the redirect.
+
+        ``params`` Dict of additional params; will override ``relay_params``.
+
+        """
+        member = self.member if member is None else member
+        url_args = {}
+        if relay_params:
+            for key in relay_params:
+                if key in self.request.params:
+                    url_args[key] = self.request.params[key]
+        if params:
+            for key in params:
+                url_args[key] = params[key]
+        url_args.update(action='show', id=member.id)
+        self._do_redirect(url_args)
+
+    def _redirect_to_collection(self):
+        self._do_redirect(dict(action='index'))
+
+    def _render(self, *args, **kwargs):
+        format = kwargs.get('format', self.format)
+        log.debug('Output format: %s' % format)
+        kwargs['format'] = format
+        render = getattr(self, '_render_%s' % format, self._render_template)
+        log.debug('Render method: %s *%s **%s' % (render.__name__, args, kwargs))
+        self.response.status = kwargs.pop('code', 200)
+        body = render(*args, **kwargs)
+        if self.max_response_size is not None:
+            if isinstance(body, bytes):
+                size = len(body)
+            elif isinstance(body, string_types):
+                # Measure what's sent (and don't encode it twice)
+                body = body.encode(self.response.charset or 'utf-8')
+                size = len(body)
+            elif isinstance(body, list):
+                size = sum(len(chunk) for chunk in body)
+            else:
+                size = 0
+            if size > self.max_response_size:
+                self.abort(400, (
+                    'The response is too large ({0} bytes; the maximum is '
+                    '{1}). Use the limit or fields params to request '
+                    'less.').format(size, self.max_response_size))
+        return body
+
+    def _render_template(self, *args, **kwargs):
+        """Render formats that don't have a ``_render_<format>`` method.
+
+        The core doesn't do templating, so this is a 406. Adapters (like the
+        Pylons :class:`restler.controller.Controller`) override this.
+
+        """
+        self.abort(406, 'Unsupported format: {0}'.format(
+            kwargs.get('format', self.format)))
+
+    def _render_json(self, block=None, **kwargs):
+        """Render a JSON response from simplified ``member``s."""
+        obj = self._get_json_object(wrap=self.wrap, block=block)
+        return self._render_object_as_json(obj)
+
+    def _render_msgpack(self, block=None, **kwargs):
+        """Render a MessagePack response from simplified ``member``s.
+
+        The same objects are rendered as for JSON, except that dates, times,
+        and decimals are encoded as extension types (see
+        :mod:`restler.msgpack_ext`).
+
+        If the `chunked` request param is set (and ``block`` isn't passed),
+        the response is rendered one member at a time (see
+        :meth:`_render_msgpack_chunked`). The response is the same either
+        way.
+
+        """
+        if msgpack_ext.msgpack is None:
+            self.abort(406, 'The msgpack package is required for this format')
+        self.response.content_type = msgpack_ext.CONTENT_TYPE
+        chunked = self.request.params.get('chunked', False)
+        if block is None and asbool(chunked):
+            return self._render_msgpack_chunked()
+        obj = self._get_json_object(wrap=self.wrap, block=block, native=True)
+        return msgpack_ext.packb(obj)
+
+    def _render_msgpack_chunked(self):
+        """Render a MessagePack response as a list of chunks.
+
+        Each member is simplified and packed on its own, so the simplified
+        collection (which is much bigger than the packed bytes) is never
+        held in memory all at once. The whole response is still rendered
+        before it's sent; it isn't streamed.
+
+        """
+        packer = msgpack_ext.make_packer()
+        items = self._get_items()
+        chunks = []
+        if self.wrap:
+            wrapper = self._wrap_object(None, len(items or ()))['response']
+            del wrapper['results']
+            header = [
+                packer.pack_map_header(1),
+                packer.pack('response'),
+                packer.pack_map_header(len(wrapper) + 1),
+            ]
+            for key, value in wrapper.items():
+                header += [packer.pack(key), packer.pack(value)]
+            header.append(packer.pack('results'))
+            chunks.append(b''.join(header))
+        if items is None:
+            chunks.append(packer.pack(None))
+            return chunks
+        chunks.append(packer.pack_array_header(len(items)))
+        paths = self.get_member_paths(items)
+        embedded = self._get_embedded(items, native=True)
+        for i, member in enumerate(items):
+            simple_member = self.entity.to_simple_collection(
+                [member], self.fields, native=True)[0]
+            simple_member['__path__'] = paths[i]
+            if embedded is not None:
+                simple_member.update(embedded[i])
+            chunks.append(packer.pack(simple_member))
+        return chunks
+
+    def _render_object_as_json(self, obj):
+        """Render an object in JSON format with correct content type.
+
+        ``obj`` must be JSONifiable by the (simple)json module.
+
+        """
+        content_type = 'application/json; charset=utf-8'
+        self.response.headers['Content-Type'] = content_type
+        return json.dumps(obj)
+
+    def _get_json_object(self, wrap=True, block=None, native=False):
+        """Get JSON object for current request.
+
+        ``wrap``
+             If set, the output will be wrapped in a dict.
+
+        ``block``
+            Can be passed to modify or wrap the object before JSONifying it.
+            In this case the wrapping discussed above under ``obj`` won't
+            happen.
+
+        ``native``
+            If set, dates, times, and decimals won't be converted (for
+            formats that can represent them natively).
+
+        """
+        items = self._get_items()
+        if items is None:
+            obj = None
+            result_count = 0
+        else:
+            obj = self.entity.to_simple_collection(
+                items, self.fields, **_native_kwargs(native))
+            paths = self.get_member_paths(items)
+            for simple_member, path in zip(obj, paths):
+                simple_member['__path__'] = path
+            embedded = self._get_embedded(items, native=native)
+            if embedded is not None:
+                for simple_member, extra in zip(obj, embedded):
+                    simple_member.update(extra)
+            result_count = len(obj)
+
+        # Wrap ``obj`` (usually)
+        if wrap:
+            obj = self._wrap_object(obj, result_count)
+        # Further modify ``obj`` if ``block`` given
+        if block is not None:
+            obj = block(obj)
+        return obj
+
+    def _get_embedded(self, items, native=False):
+        """Get related members to embed in ``items`` (see :attr:`embed`).
+
+        Returns a list with a dict of embedded relationships for each item,
+        or `None` if nothing is to be embedded.
+
+        """
+        if not self.embed or not items:
+            return None
+        with self._statement_timeout():
+            return embed_related(
+                self.db_session, class_mapper(self.entity), items, self.embed,
+                native=native)
+
+    def _get_items(self):
+        """Get list of items to render (or `None` if there aren't any)."""
+        if self.collection is not None:
+            log.debug('Rendering collection')
+            return self.collection
+        elif self.member is not None:
+            log.debug('Rendering member')
+            return [self.member]
+        log.debug('Neither collection nor member was set.')
+        return None
+
+    def _wrap_object(self, obj, result_count):
+        """Wrap ``obj`` in a dict along with metadata about the request."""
+        request = self.request
+        wrapped = dict(
+            response=dict(
+                results=obj,
+                result_count=result_count,
+                request=dict(
+                    method=request.method,
+                    full_url=request.url,  # URL with query string
+                    host_url=request.host_url,  # URL of host (no path or query)
+                    app_prefix=request.script_name,  # Path to app
+                    path=request.path,  # Path *including* app prefix
+                    collection_path=self.collection_path,  # *Includes* app prefix
+                    params=(list(request.params.items()) or None),
+                    query_string=(request.query_string or None),
+                ),
+            )
+        )
+        if self.sync is not None:
+            wrapped['response']['sync'] = self.sync
+        return wrapped
+
+    @property
+    def fields(self):
+        """Return list of fields to include in response.
+
+        The `fields` request parameter should be a JSON `list`. This property
+        merely decodes the parameter from JSON into a Python object and
+        returns it. See :class:`restler.entity.Entity` for documentation on
+        the expected form and contents of the list.
+
+        Example (URL-encoded)::
+
+            /path?fields=["*","%2Bmy_attr"]
+
+            Decoded from JSON: `['*', '+my_attr']`
+
+        """
+        try:
+            self._fields
+        except AttributeError:
+            fields = self.request.params.get('fields', None)
+            if fields is not None:
+                fields = json.loads(fields)
+            self._fields = fields
+        return self._fields
+
+    @property
+    def embed(self):
+        """Return list of relationships to embed in response.
+
+        The `embed` request parameter should be a JSON `list`; see
+        :mod:`restler.embed` for its form. The relationships are checked
+        against `embeddable`, `max_embed_depth`, and the embed limits; if
+        any are exceeded, the request is aborted with a 400.
+
+        Example (URL-encoded)::
+
+            /routes?embed=[{"name":"stops","limit":10,"fields":["name"]}]
+
+        """
+        try:
+            self._embed
+        except AttributeError:
+            embed = self.request.params.get('embed', None)
+            if embed:
+                try:
+                    embed = parse_embed(
+                        class_mapper(self.entity), json.loads(embed),
+                        max_depth=self.max_embed_depth,
+                        default_limit=self.default_embed_limit,
+                        max_limit=self.max_embed_limit,
+                        allowed=self.embeddable)
+                except ValueError as e:
+                    self.abort(400, str(e))
+            self._embed = embed or None
+        return self._embed
+
+    def _get_wrap(self):
+        try:
+            self._wrap
+        except AttributeError:
+            self._set_wrap()
+        return self._wrap
+    def _set_wrap(self, value=None):
+        """Set whether to wrap a template in its parent template.
+
+        If ``value`` is given, use that value. If ``wrap`` is set in
+        ``request.params``, convert its value to ``bool`` and use that
+        value. Otherwise, set ``self.wrap`` to True.
+
+        ``value``
+            ``bool`` indicating whether or not a template should be
+            wrapped in its inherited templates. ``wrap`` gets passed along
+            to the template, which can decide to do whatever it wants with
+            it.
+
+        """
+        if value is None:
+            wrap = self.request.params.get('wrap', 'true')
+            self._wrap = asbool(wrap)
+        else:
+            self._wrap = value
+    wrap = property(_get_wrap, _set_wrap)
+
+    def _set_property(self, names, value):
+        """Set attributes (aliases) with ``names`` to ``value``."""
+        for name in names:
+            self.__dict__[name] = value
+
+    def _p_get_collection(self):
+        return self.__dict__.get('collection', None)
+    def _p_set_collection(self, collection):
+        self._set_property(
+            ['collection', self.collection_name], collection)
+    collection = property(_p_get_collection, _p_set_collection)
+
+    def _p_get_member(self):
+        return self.__dict__.get('member', None)
+    def _p_set_member(self, member):
+        self._set_property(['member', self.member_name], member)
+    member = property(_p_get_member, _p_set_member)
+
+    def _init_properties(self):
+        cls = self.__class__
+        setattr(cls, self.collection_name, cls.collection)
+        setattr(cls, self.member_name, cls.member)
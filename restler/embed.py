@@ -0,0 +1,263 @@
+"""Embedding related members in responses.
+
+The `embed` request param names relationships whose related members are
+included in each member of the response (as a list or, for many-to-one
+relationships, a single object). It's a JSON list; each item is either a
+relationship name or an object with these keys:
+
+    ``name``
+        The relationship name (required).
+
+    ``limit``
+        Maximum number of related members embedded per member.
+
+    ``fields``
+        Fields of the related members to include; these have the same
+        semantics as the `fields` param (see :class:`restler.entity.Entity`).
+
+    ``embed``
+        Relationships of the related members to embed (same form as `embed`).
+
+Dotted names are shorthand for nested relationships, so these are
+equivalent::
+
+    ["stops.times"]
+    [{"name": "stops", "embed": ["times"]}]
+
+Related members are loaded with one query per relationship for all the
+members being rendered instead of one query per member. The query joins
+from the members (selected using `IN` on their primary keys) via the
+relationship, so its whole join condition is used, including any extra
+criteria in a custom `primaryjoin` or `secondaryjoin`. Many-to-many
+relationships (with a secondary table) are supported. When a relationship
+has a limit and the database supports window functions, the limit is
+applied per member in the query (with `row_number()`); otherwise, all the
+related members are loaded and the extras are discarded.
+
+"""
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from sqlalchemy import func, tuple_
+from sqlalchemy.orm import RelationshipProperty, aliased
+
+from restler.entity import _native_kwargs, string_types
+
+
+IN_CHUNK_SIZE = 500
+"""Maximum number of keys in each `IN` clause."""
+
+
+class Embed(object):
+    """A relationship to embed."""
+
+    def __init__(self, name, limit=None, fields=None, embed=None):
+        self.name = name
+        self.limit = limit
+        self.fields = fields
+        self.embed = embed or []
+
+    def __repr__(self):
+        return 'Embed({0!r}, limit={1!r}, fields={2!r}, embed={3!r})'.format(
+            self.name, self.limit, self.fields, self.embed)
+
+
+def parse_embed(mapper, value, max_depth=None, default_limit=None,
+                max_limit=None, allowed=None):
+    """Parse the (JSON decoded) `embed` param ``value``.
+
+    ``mapper`` is the mapper of the members the relationships are embedded
+    in. ``allowed`` is a collection of the relationship names (dotted for
+    nested relationships) that can be embedded; if it's `None`, any can be.
+    ``default_limit`` and ``max_limit`` apply to each relationship's
+    `limit`.
+
+    Returns a list of :class:`Embed`s. Raises `ValueError` if ``value`` is
+    invalid or exceeds one of the limits.
+
+    """
+    specs = _parse(mapper, value, '', 1, max_depth, allowed)
+    _set_limits(specs, default_limit, max_limit)
+    return specs
+
+
+def _parse(mapper, value, prefix, depth, max_depth, allowed):
+    if not isinstance(value, list):
+        value = [value]
+    specs = []
+    by_name = {}
+    for item in value:
+        if isinstance(item, string_types):
+            item = dict(name=item)
+        elif (not isinstance(item, dict) or
+                not isinstance(item.get('name'), string_types)):
+            raise ValueError(
+                'Expected a relationship name or an object with a name: '
+                '{0}'.format(json.dumps(item)))
+        name, _, rest = item['name'].partition('.')
+        if rest:
+            item = dict(name=name, embed=[dict(item, name=rest)])
+        path = prefix + name
+        if max_depth is not None and depth > max_depth:
+            raise ValueError(
+                'Relationships can be embedded at most {0} levels deep: '
+                '{1}'.format(max_depth, path))
+        if allowed is not None and path not in allowed:
+            raise ValueError(
+                'Relationship cannot be embedded: {0}'.format(path))
+        prop = mapper.get_property(name) if mapper.has_property(name) else None
+        if not isinstance(prop, RelationshipProperty):
+            raise ValueError('Unknown relationship: {0}'.format(path))
+        fields = item.get('fields')
+        if fields is not None and not isinstance(fields, (list, dict)):
+            raise ValueError('Fields must be a list: {0}'.format(path))
+        if name not in by_name:
+            # Repeated names are merged
+            specs.append(Embed(name))
+            by_name[name] = (specs[-1], prop.mapper, [])
+        spec, related_mapper, nested = by_name[name]
+        if item.get('limit') is not None:
+            spec.limit = item['limit']
+        if fields is not None:
+            spec.fields = fields
+        embed = item.get('embed')
+        if embed:
+            nested.extend(embed if isinstance(embed, list) else [embed])
+    for spec, related_mapper, nested in by_name.values():
+        if nested:
+            spec.embed = _parse(
+                related_mapper, nested, prefix + spec.name + '.', depth + 1,
+                max_depth, allowed)
+    return specs
+
+
+def _set_limits(specs, default_limit, max_limit):
+    for spec in specs:
+        limit = spec.limit
+        if limit is None:
+            limit = default_limit if default_limit is not None else max_limit
+        if limit is not None:
+            try:
+                limit = int(limit)
+            except (TypeError, ValueError):
+                raise ValueError('Limit must be an integer: {0}'.format(limit))
+            if limit < 0:
+                raise ValueError(
+                    'Limit must not be negative: {0}'.format(limit))
+            if max_limit is not None and limit > max_limit:
+                raise ValueError(
+                    'Limit must be no more than {0}'.format(max_limit))
+        spec.limit = limit
+        _set_limits(spec.embed, default_limit, max_limit)
+
+
+def load_related(session, mapper, prop, members, limit=None):
+    """Load members related to ``members`` via relationship ``prop``.
+
+    The related members for all of ``members`` are loaded with one query
+    (per `IN_CHUNK_SIZE` members). Returns a list of lists of related
+    members, one for each of ``members``, ordered by the relationship's
+    `order_by` (or primary key) and truncated to ``limit``.
+
+    """
+    member_keys = [
+        tuple(mapper.primary_key_from_instance(m)) for m in members]
+    keys = list(set(k for k in member_keys if None not in k))
+    related_class = prop.mapper.class_
+    order_by = prop.order_by or prop.mapper.primary_key
+    # The members' table is aliased in case the relationship is
+    # self-referential
+    parent = aliased(mapper.class_)
+    parent_key = [getattr(parent, mapper.get_property_by_column(c).key)
+                  for c in mapper.primary_key]
+    use_window = (
+        limit is not None and
+        supports_window_functions(session.get_bind(mapper).dialect))
+    groups = {}
+    for i in range(0, len(keys), IN_CHUNK_SIZE):
+        chunk = keys[i:i + IN_CHUNK_SIZE]
+        if len(parent_key) == 1:
+            criterion = parent_key[0].in_([k[0] for k in chunk])
+        else:
+            criterion = tuple_(*parent_key).in_(chunk)
+        key_columns = [
+            c.label('restler_key_{0}'.format(j))
+            for (j, c) in enumerate(parent_key)]
+        if use_window:
+            row_number = func.row_number().over(
+                partition_by=parent_key, order_by=order_by)
+            q = session.query(
+                related_class, row_number.label('restler_row_number'),
+                *key_columns)
+            q = q.select_from(parent).join(getattr(parent, prop.key))
+            subquery = q.filter(criterion).subquery()
+            related = aliased(related_class, subquery)
+            key_columns = [subquery.c[c.name] for c in key_columns]
+            q = session.query(related, *key_columns)
+            q = q.filter(subquery.c.restler_row_number <= limit)
+            q = q.order_by(*(key_columns + [subquery.c.restler_row_number]))
+        else:
+            q = session.query(related_class, *key_columns)
+            q = q.select_from(parent).join(getattr(parent, prop.key))
+            q = q.filter(criterion).order_by(*order_by)
+        for row in q:
+            groups.setdefault(tuple(row[1:]), []).append(row[0])
+    return [groups.get(key, [])[:limit] for key in member_keys]
+
+
+def supports_window_functions(dialect):
+    """Whether the database for ``dialect`` supports `row_number()`."""
+    name = dialect.name
+    if name in ('postgresql', 'oracle', 'mssql'):
+        return True
+    if name == 'sqlite':
+        dbapi = getattr(dialect, 'dbapi', None)
+        version = getattr(dbapi, 'sqlite_version_info', (0,))
+        return version >= (3, 25)
+    if name in ('mysql', 'mariadb'):
+        version = getattr(dialect, 'server_version_info', None) or (0,)
+        if getattr(dialect, 'is_mariadb', False):
+            return version >= (10, 2)
+        return version >= (8,)
+    return False
+
+
+def embed_related(session, mapper, members, specs, native=False):
+    """Load and simplify related members to embed in ``members``.
+
+    Returns a list with a dict for each of ``members`` that maps the names
+    of the relationships in ``specs`` to the simplified related members (a
+    list, or a single object or `None` for many-to-one relationships).
+    Related classes must be :class:`restler.entity.Entity`s.
+
+    """
+    embedded = [{} for m in members]
+    if not members:
+        return embedded
+    for spec in specs:
+        prop = mapper.get_property(spec.name)
+        related = load_related(session, mapper, prop, members, spec.limit)
+        # Simplify each distinct related member once
+        distinct = []
+        seen = set()
+        for group in related:
+            for obj in group:
+                if id(obj) not in seen:
+                    seen.add(id(obj))
+                    distinct.append(obj)
+        simple = prop.mapper.class_.to_simple_collection(
+            distinct, spec.fields, **_native_kwargs(native))
+        if spec.embed:
+            nested = embed_related(
+                session, prop.mapper, distinct, spec.embed, native=native)
+            for simple_obj, extra in zip(simple, nested):
+                simple_obj.update(extra)
+        simple_by_id = dict((id(o), s) for (o, s) in zip(distinct, simple))
+        for member_embedded, group in zip(embedded, related):
+            value = [simple_by_id[id(obj)] for obj in group]
+            if not prop.uselist:
+                value = value[0] if value else None
+            member_embedded[spec.name] = value
+    return embedded
@@ -16,6 +16,14 @@ from string import ascii_uppercase
 from sqlalchemy import Column
 from sqlalchemy.orm import class_mapper
 
+try:
+    string_types = basestring
+    integer_types = (int, long)
+except NameError:
+    # Python 3
+    string_types = str
+    integer_types = (int,)
+
 
 datetime_types = (datetime.time, datetime.date, datetime.datetime)
 
@@ -32,8 +40,28 @@ def camel_to_underscore(name):
     return name
 
 
+def _native_kwargs(native):
+    """Keyword args for passing ``native`` on to the simplify methods.
+
+    It's only passed when set so that overrides of these methods written
+    before it was added (without a ``native`` arg) keep working.
+
+    """
+    return {'native': True} if native else {}
+
+
 class Entity(object):
 
+    sync_column = None
+    """Name of column used for incremental sync.
+
+    Its value must increase across the whole table whenever a row changes,
+    and values must be committed in increasing order, so timestamps and
+    plain sequences aren't safe. Use `Resource.sync_counter_table` (or
+    :func:`restler.sync.next_sync_value`). See :mod:`restler.sync`.
+
+    """
+
     @property
     def id(self):
         pk = self._sa_instance_state.key
@@ -48,12 +76,89 @@ class Entity(object):
     @property
     def id_str(self):
         """Convert `id` from Python to string."""
-        if isinstance(self.id, basestring):
-            id = self.id
-        else:
-            id = json.dumps(self.simplify_object(self.id))
+        id = self.id
+        if not isinstance(id, string_types):
+            id = json.dumps(self.simplify_object(id))
         return id
 
+    @classmethod
+    def ids_to_str(cls, members):
+        """Convert the IDs of ``members`` to strings in bulk.
+
+        The results are the same as getting `id_str` for each member, but the
+        key encoder is set up once per class: single-column keys that are
+        strings or integers don't go through the JSON encoder at all, and
+        composite keys are encoded a column at a time.
+
+        """
+        if not members:
+            return []
+        encode = cls._get_id_encoder()
+        if encode is None or not isinstance(members[0], cls):
+            return [getattr(m, 'id_str', None) for m in members]
+        keys = [m._sa_instance_state.key for m in members]
+        if None in keys:
+            # Transient or pending members don't have identity keys
+            return [m.id_str for m in members]
+        return encode([key[1] for key in keys])
+
+    @classmethod
+    def _get_id_encoder(cls):
+        """Get function that converts identity key values to ID strings.
+
+        Returns `None` if `id` or `id_str` is overridden such that the ID
+        can't be derived from the identity key.
+
+        """
+        try:
+            return cls.__dict__['_id_encoder']
+        except KeyError:
+            pass
+        mapper = class_mapper(cls)
+        pk = mapper.primary_key
+        id_attr = getattr(cls, 'id', None)
+        if getattr(cls, 'id_str', None) is not Entity.__dict__['id_str']:
+            encode = None
+        elif (id_attr is not Entity.__dict__['id'] and not (
+                len(pk) == 1 and
+                mapper.get_property_by_column(pk[0]).key == 'id')):
+            encode = None
+        elif len(pk) == 1:
+            encode = cls._make_single_id_encoder()
+        else:
+            encode = cls._make_composite_id_encoder()
+        cls._id_encoder = encode
+        return encode
+
+    @classmethod
+    def _make_single_id_encoder(cls):
+        simplify = cls.simplify_object
+        def encode(key_vals):
+            ids = []
+            for (val,) in key_vals:
+                if isinstance(val, string_types):
+                    ids.append(val)
+                elif type(val) in integer_types:
+                    ids.append(str(val))
+                else:
+                    ids.append(json.dumps(simplify(val)))
+            return ids
+        return encode
+
+    @classmethod
+    def _make_composite_id_encoder(cls):
+        simplify = cls.simplify_object
+        def encode_part(val):
+            if type(val) in integer_types:
+                return str(val)
+            return json.dumps(simplify(val))
+        def encode(key_vals):
+            columns = [
+                [encode_part(val) for val in column]
+                for column in zip(*key_vals)]
+            return ['[%s]' % ', '.join(parts) for parts in zip(*columns)]
+        return encode
+
     @classmethod
     def str_to_id(cls, id):
         """Convert ``id`` from string to Python.
@@ -89,16 +194,27 @@ class Entity(object):
         return val
 
     @classmethod
-    def simplify_object(cls, obj, name=None):
-        """Convert ``obj`` to something JSON encoder can handle."""
+    def simplify_object(cls, obj, name=None, native=False):
+        """Convert ``obj`` to something JSON encoder can handle.
+
+        If ``native`` is set, dates, times, and decimals are left as is (for
+        encoders that can handle them natively).
+
+        """
+        kwargs = _native_kwargs(native)
         try:
             obj.to_simple_object
         except AttributeError:
             pass
         else:
-            obj = obj.to_simple_object()
+            if native and isinstance(obj, Entity):
+                obj = obj.to_simple_object(native=True)
+            else:
+                obj = obj.to_simple_object()
         if isinstance(obj, (list, tuple)):
-            obj = [cls.simplify_object(i) for i in obj]
+            obj = [cls.simplify_object(i, **kwargs) for i in obj]
+        elif native:
+            pass
         elif isinstance(obj, decimal.Decimal):
             f, i = float(obj), int(obj)
             obj = i if f == i else f
@@ -106,13 +222,15 @@ class Entity(object):
             obj = str(obj)
         return obj
 
-    def to_simple_object(self, fields=None):
+    def to_simple_object(self, fields=None, native=False):
         """Convert and return simplified form of `self` that can be JSONified.
 
         See :meth:`_parse_fields_for_simple_object` for description of
-        ``fields``.
+        ``fields``. See :meth:`simplify_object` for description of
+        ``native``.
 
         """
+        kwargs = _native_kwargs(native)
         obj = dict(
             __module__=self.__class__.__module__,
             __type__=self.__class__.__name__,
@@ -125,7 +243,7 @@ class Entity(object):
                 if o is None:
                     break
                 o = getattr(o, n)
-            val = self.simplify_object(o, n)
+            val = self.simplify_object(o, n, **kwargs)
             if name == as_name:
                 # If `name` has only one part, this sets obj[name] = val.
                 # If `name` has more than one part (N parts), this sets
@@ -185,7 +303,7 @@ class Entity(object):
         include_fields = set()
         exclude_fields = set()
         for item in fields:
-            if isinstance(item, basestring):
+            if isinstance(item, string_types):
                 name, as_name = item, item
             elif isinstance(item, dict):
                 name, as_name = item['name'], item['mapping']
@@ -207,7 +325,10 @@ class Entity(object):
         return json.dumps(self.to_simple_object(fields=fields))
 
     @classmethod
-    def to_simple_collection(cls, collection, fields=None):
+    def to_simple_collection(cls, collection, fields=None, native=False):
+        if not collection:
+            return []
+        kwargs = _native_kwargs(native)
         try:
             collection[0].to_simple_object
         except AttributeError:
@@ -217,10 +338,10 @@ class Entity(object):
                 keys = m.keys()
                 vals = (getattr(m, k) for k in keys)
                 dicts.append(dict(zip(keys, vals)))
-            return [cls.simplify_object(d) for d in dicts]
+            return [cls.simplify_object(d, **kwargs) for d in dicts]
         else:
             # Assume collection of instances of a mapped class
-            return [m.to_simple_object(fields) for m in collection]
+            return [m.to_simple_object(fields, **kwargs) for m in collection]
 
     @classmethod
     def to_json_collection(cls, collection=None, fields=None):
@@ -0,0 +1,134 @@
+"""MessagePack encoding with extension types for dates and decimals.
+
+JSON responses have dates and times converted to strings and decimals
+converted to floats (or ints). MessagePack responses keep these types intact
+using the following extension types, each of which contains a UTF-8 encoded
+string:
+
+    ===== =================== ================================
+    Code  Type                Data
+    ===== =================== ================================
+    1     `datetime.datetime` ISO 8601 (`datetime.isoformat()`)
+    2     `datetime.date`     ISO 8601 (YYYY-MM-DD)
+    3     `datetime.time`     ISO 8601 (`time.isoformat()`)
+    4     `decimal.Decimal`   `str(decimal)`
+    ===== =================== ================================
+
+:func:`unpackb` (and :func:`ext_hook` for use with other unpackers) decodes
+these back to the original types. Datetimes and times with time zone info
+get a fixed UTC offset (the offset the original had).
+
+Datetimes aren't encoded with MessagePack's standard Timestamp extension
+type (-1). That type is a point in time in UTC, so naive datetimes (which
+is what most databases return) couldn't be round-tripped, and the UTC
+offset of aware datetimes would be lost. Clients in other languages need to
+register these extension types (they're simple to decode).
+
+The `msgpack` package is required.
+
+"""
+import datetime
+import decimal
+import re
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+CONTENT_TYPE = 'application/x-msgpack'
+
+DATETIME = 1
+DATE = 2
+TIME = 3
+DECIMAL = 4
+
+_datetime_formats = ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S')
+_time_formats = ('%H:%M:%S.%f', '%H:%M:%S')
+_utc_offset_re = re.compile(r'([+-])(\d\d):(\d\d)(?::(\d\d)(?:\.(\d+))?)?$')
+
+
+def default(obj):
+    """Convert types msgpack doesn't know about to extension types."""
+    if isinstance(obj, datetime.datetime):
+        code, data = DATETIME, obj.isoformat()
+    elif isinstance(obj, datetime.date):
+        code, data = DATE, obj.isoformat()
+    elif isinstance(obj, datetime.time):
+        code, data = TIME, obj.isoformat()
+    elif isinstance(obj, decimal.Decimal):
+        code, data = DECIMAL, str(obj)
+    else:
+        raise TypeError('Cannot serialize %r' % (obj,))
+    return msgpack.ExtType(code, data.encode('utf-8'))
+
+
+class _UTCOffset(datetime.tzinfo):
+    """Fixed offset from UTC (for Python versions without `timezone`)."""
+
+    def __init__(self, offset):
+        self.offset = offset
+
+    def utcoffset(self, dt):
+        return self.offset
+
+    def dst(self, dt):
+        return datetime.timedelta(0)
+
+    def tzname(self, dt):
+        return None
+
+    def __repr__(self):
+        return '_UTCOffset(%r)' % self.offset
+
+
+def _strptime(value, formats):
+    """Parse ISO 8601 ``value``, keeping its UTC offset (if any)."""
+    tzinfo = None
+    match = _utc_offset_re.search(value)
+    if match is not None:
+        sign, hours, minutes, seconds, fraction = match.groups()
+        offset = datetime.timedelta(
+            hours=int(hours), minutes=int(minutes), seconds=int(seconds or 0),
+            microseconds=int((fraction or '0').ljust(6, '0')))
+        tzinfo = _UTCOffset(-offset if sign == '-' else offset)
+        value = value[:match.start()]
+    for fmt in formats:
+        try:
+            return datetime.datetime.strptime(value, fmt).replace(
+                tzinfo=tzinfo)
+        except ValueError:
+            pass
+    raise ValueError('Could not parse date/time: %s' % value)
+
+
+def ext_hook(code, data):
+    """Convert extension types created by :func:`default` back."""
+    if code not in (DATETIME, DATE, TIME, DECIMAL):
+        return msgpack.ExtType(code, data)
+    value = data.decode('utf-8')
+    if code == DATETIME:
+        if hasattr(datetime.datetime, 'fromisoformat'):
+            # Python 3.7+
+            return datetime.datetime.fromisoformat(value)
+        return _strptime(value, _datetime_formats)
+    elif code == DATE:
+        return _strptime(value, ('%Y-%m-%d',)).date()
+    elif code == TIME:
+        if hasattr(datetime.time, 'fromisoformat'):
+            return datetime.time.fromisoformat(value)
+        return _strptime(value, _time_formats).timetz()
+    return decimal.Decimal(value)
+
+
+def make_packer():
+    return msgpack.Packer(default=default, use_bin_type=True)
+
+
+def packb(obj):
+    return msgpack.packb(obj, default=default, use_bin_type=True)
+
+
+def unpackb(data):
+    return msgpack.unpackb(data, ext_hook=ext_hook, raw=False)
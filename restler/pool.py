@@ -0,0 +1,258 @@
+"""Connection pool pre-warming and metrics.
+
+:func:`prewarm` opens connections ahead of time so the first requests after
+startup don't pay for connection establishment.
+
+:class:`PoolMetrics` keeps track of how a pool is being used: how many
+connections are checked out, how many overflow connections are open, and how
+long checkouts take (including waiting for a free connection and connecting
+when the pool has to open a new one). :func:`get_pool_metrics` returns the
+metrics for an engine, creating them as needed, and :func:`metrics_app` is
+a WSGI app that exposes the metrics for all instrumented engines so they can
+be scraped.
+
+"""
+import logging
+import threading
+import time
+try:
+    import json
+except ImportError:
+    import simplejson as json
+try:
+    from urllib.parse import parse_qs
+except ImportError:
+    from urlparse import parse_qs
+
+try:
+    from sqlalchemy import event
+except ImportError:
+    # SQLAlchemy < 0.7; new connections won't be counted
+    event = None
+from sqlalchemy.pool import NullPool, SingletonThreadPool, StaticPool
+
+
+log = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+"""Upper bounds (in milliseconds) of checkout latency histogram buckets."""
+
+UNPOOLED = (NullPool, SingletonThreadPool, StaticPool)
+"""Pool classes that :func:`prewarm` skips.
+
+These don't keep a set of connections that requests share: `NullPool` closes
+connections when they're returned, `SingletonThreadPool` keeps one
+connection per thread (so connections opened by other threads would never be
+used), and `StaticPool` only ever has one connection.
+
+"""
+
+_metrics = {}
+_metrics_lock = threading.Lock()
+
+
+def prewarm(engine, connections):
+    """Open ``connections`` connections in ``engine``'s pool.
+
+    The connections are opened concurrently, then returned to the pool. The
+    number is capped at the pool's size (connections opened beyond that
+    would be discarded when returned). Pools in :data:`UNPOOLED` aren't
+    pre-warmed. Returns the number of connections that were opened.
+
+    """
+    if isinstance(engine.pool, UNPOOLED):
+        log.info('Not pre-warming %s for %s' % (
+            engine.pool.__class__.__name__, engine))
+        return 0
+    size = _get_stat(engine.pool, 'size')
+    if size is not None:
+        connections = min(connections, size)
+    opened = []
+    errors = []
+    def connect():
+        try:
+            opened.append(engine.connect())
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=connect) for i in range(connections)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    for conn in opened:
+        conn.close()
+    for e in errors:
+        log.error('Error pre-warming connection pool: %s' % e)
+    log.info('Pre-warmed %s connection(s) for %s' % (len(opened), engine))
+    return len(opened)
+
+
+def _get_stat(pool, name):
+    """Get stat ``name`` from ``pool``, or `None` if it's not supported.
+
+    Most stats are methods, but some pool classes have plain attributes
+    (e.g., `SingletonThreadPool.size` is an int).
+
+    """
+    value = getattr(pool, name, None)
+    return value() if callable(value) else value
+
+
+def get_pool_metrics(engine):
+    """Get :class:`PoolMetrics` for ``engine``, instrumenting it if needed."""
+    key = id(engine)
+    try:
+        return _metrics[key]
+    except KeyError:
+        with _metrics_lock:
+            if key not in _metrics:
+                _metrics[key] = PoolMetrics(engine)
+            return _metrics[key]
+
+
+def all_pool_metrics():
+    """Return snapshots of metrics for all instrumented engines."""
+    return [m.snapshot() for m in list(_metrics.values())]
+
+
+class PoolMetrics(object):
+
+    def __init__(self, engine, buckets=DEFAULT_BUCKETS):
+        self.engine = engine
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self.reset()
+        self.pool = None
+        self._instrument()
+
+    def reset(self):
+        with self._lock:
+            self.checkouts = 0
+            self.connects = 0
+            self.checkout_time = 0
+            self.max_checkout_time = 0
+            # One extra slot for checkouts slower than the largest bucket
+            self.histogram = [0] * (len(self.buckets) + 1)
+
+    def _instrument(self):
+        """Wrap the pool's `connect` method to time checkouts.
+
+        Engines get connections from the pool by calling `pool.connect`, so
+        replacing that method on the pool instance lets us time every
+        checkout. Engines replace their pool when disposed; we re-instrument
+        when that happens (see :meth:`snapshot`).
+
+        """
+        pool = self.engine.pool
+        connect = pool.connect
+        def timed_connect(*args, **kwargs):
+            t0 = time.time()
+            try:
+                return connect(*args, **kwargs)
+            finally:
+                self.record_checkout(time.time() - t0)
+        pool.connect = timed_connect
+        if event is not None:
+            event.listen(pool, 'connect', self._on_connect)
+        self.pool = pool
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.connects += 1
+
+    def record_checkout(self, duration):
+        ms = duration * 1000
+        for i, bound in enumerate(self.buckets):
+            if ms <= bound:
+                break
+        else:
+            i = len(self.buckets)
+        with self._lock:
+            self.checkouts += 1
+            self.checkout_time += duration
+            self.max_checkout_time = max(self.max_checkout_time, duration)
+            self.histogram[i] += 1
+
+    def snapshot(self):
+        """Return current metrics as a dict.
+
+        Pool stats that aren't supported by the engine's pool class (e.g.,
+        `overflow` for pools other than `QueuePool`) are `None`.
+
+        """
+        if self.engine.pool is not self.pool:
+            self._instrument()
+        pool = self.pool
+        stat = lambda name: _get_stat(pool, name)
+        with self._lock:
+            histogram = []
+            cumulative = 0
+            for bound, count in zip(self.buckets + (None,), self.histogram):
+                cumulative += count
+                histogram.append((bound, cumulative))
+            return dict(
+                engine=_url_to_string(self.engine.url),
+                pool_class=pool.__class__.__name__,
+                size=stat('size'),
+                checked_out=stat('checkedout'),
+                checked_in=stat('checkedin'),
+                overflow=stat('overflow'),
+                connects=self.connects,
+                checkouts=self.checkouts,
+                checkout_time=self.checkout_time,
+                max_checkout_time=self.max_checkout_time,
+                checkout_latency_ms=histogram,
+            )
+
+
+def _url_to_string(url):
+    """Convert engine URL to string without its password."""
+    render = getattr(url, 'render_as_string', None)
+    if render is None:
+        # SQLAlchemy < 1.4
+        render = url.__to_string__
+    return render(hide_password=True)
+
+
+def _to_prometheus(snapshots):
+    lines = []
+    def add(name, value, labels):
+        if value is None:
+            return
+        label_str = ','.join('%s="%s"' % item for item in sorted(labels.items()))
+        lines.append('restler_pool_%s{%s} %s' % (name, label_str, value))
+    for s in snapshots:
+        labels = dict(engine=s['engine'])
+        for name in ('size', 'checked_out', 'checked_in', 'overflow'):
+            add(name, s[name], labels)
+        add('connects_total', s['connects'], labels)
+        add('max_checkout_seconds', s['max_checkout_time'], labels)
+        for bound, count in s['checkout_latency_ms']:
+            le = '+Inf' if bound is None else str(bound / 1000.0)
+            add('checkout_seconds_bucket', count, dict(labels, le=le))
+        add('checkout_seconds_sum', s['checkout_time'], labels)
+        add('checkout_seconds_count', s['checkouts'], labels)
+    return '\n'.join(lines) + '\n'
+
+
+def metrics_app(environ, start_response):
+    """WSGI app that serves metrics for all instrumented pools.
+
+    Metrics are served in the Prometheus text format by default or as JSON
+    when the `format` query param is ``json``.
+
+    """
+    snapshots = all_pool_metrics()
+    params = parse_qs(environ.get('QUERY_STRING', ''))
+    if params.get('format', [None])[-1] == 'json':
+        body = json.dumps(snapshots)
+        content_type = 'application/json'
+    else:
+        body = _to_prometheus(snapshots)
+        content_type = 'text/plain; version=0.0.4'
+    body = body.encode('utf-8')
+    start_response('200 OK', [
+        ('Content-Type', content_type),
+        ('Content-Length', str(len(body))),
+    ])
+    return [body]
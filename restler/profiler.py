@@ -0,0 +1,216 @@
+"""Per-request profiling.
+
+:class:`RequestProfiler` captures a cProfile profile and every SQL statement
+(with its duration) executed while it's running, then writes a report that
+flags statements that were executed repeatedly with the same "shape"--the
+usual signature of N+1 queries, e.g. lazy loads triggered by dotted names in
+the `fields` param.
+
+"""
+import cProfile
+import logging
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+try:
+    from sqlalchemy import event
+except ImportError:
+    # SQLAlchemy < 0.7; SQL statements won't be captured
+    event = None
+
+
+log = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+# Only one profiler runs at a time. On Python 3.12+, cProfile is process-wide
+# (enabling a second profiler raises an error, and a profiler records every
+# thread), and one at a time also keeps reports from overlapping.
+
+_literal_re = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_in_list_re = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+_space_re = re.compile(r'\s+')
+
+
+def statement_shape(statement):
+    """Normalize SQL ``statement`` so that similar statements compare equal.
+
+    Literals are replaced with "?", IN lists are collapsed, and whitespace is
+    normalized.
+
+    """
+    shape = _literal_re.sub('?', statement)
+    shape = _in_list_re.sub('(?)', shape)
+    shape = _space_re.sub(' ', shape)
+    return shape.strip()
+
+
+class RequestProfiler(object):
+
+    def __init__(self, engines=(), repeat_threshold=3):
+        self.engines = [e for e in engines if e is not None]
+        self.repeat_threshold = repeat_threshold
+        self.statements = []
+        self.profile = cProfile.Profile()
+        self.started_at = None
+        self.duration = None
+        self.active = False
+        self._thread_id = None
+        self._listeners = []
+
+    def start(self):
+        """Start profiling.
+
+        Returns `False` without starting if another profiler is active (in
+        any thread).
+
+        """
+        if not _lock.acquire(False):
+            return False
+        try:
+            self._thread_id = threading.current_thread().ident
+            if event is not None:
+                for engine in self.engines:
+                    for name, func in (('before_cursor_execute', self._before),
+                                       ('after_cursor_execute', self._after)):
+                        event.listen(engine, name, func)
+                        self._listeners.append((engine, name, func))
+            self.started_at = time.time()
+            self.profile.enable()
+        except Exception:
+            self._remove_listeners()
+            _lock.release()
+            raise
+        self.active = True
+        return True
+
+    def stop(self):
+        if not self.active:
+            return
+        try:
+            self.profile.disable()
+            self.duration = time.time() - self.started_at
+        finally:
+            self.active = False
+            self._remove_listeners()
+            _lock.release()
+
+    def _remove_listeners(self):
+        while self._listeners:
+            engine, name, func = self._listeners.pop()
+            event.remove(engine, name, func)
+
+    def _before(self, conn, cursor, statement, parameters, context, many):
+        # Engine events fire for every thread; only record ours
+        if threading.current_thread().ident == self._thread_id:
+            conn.info.setdefault('restler_profiler_t0', []).append(time.time())
+
+    def _after(self, conn, cursor, statement, parameters, context, many):
+        if threading.current_thread().ident == self._thread_id:
+            t0 = conn.info['restler_profiler_t0'].pop()
+            self.statements.append((statement, time.time() - t0))
+
+    @property
+    def sql_time(self):
+        return sum(duration for statement, duration in self.statements)
+
+    def repeated_statements(self):
+        """Return list of (shape, count, total time) for repeated statements.
+
+        Only statements that were executed at least `repeat_threshold` times
+        are included. The list is sorted by count, descending.
+
+        """
+        shapes = {}
+        for statement, duration in self.statements:
+            shape = statement_shape(statement)
+            count, total = shapes.get(shape, (0, 0))
+            shapes[shape] = (count + 1, total + duration)
+        repeated = [
+            (shape, count, total) for shape, (count, total) in shapes.items()
+            if count >= self.repeat_threshold]
+        repeated.sort(key=lambda r: r[1], reverse=True)
+        return repeated
+
+    def get_report(self, title=None, fields=None, stats_limit=30):
+        """Return a plain text report.
+
+        ``fields`` is the list of fields requested for the response; dotted
+        names in it are reported as likely causes of repeated statements.
+
+        """
+        out = StringIO()
+        write = lambda line='': out.write(line + '\n')
+        if title:
+            write(title)
+            write('=' * len(title))
+            write()
+        write('Total time: %.3fs' % self.duration)
+        if sys.version_info >= (3, 12):
+            write('(The profile includes work done by other threads.)')
+        write('SQL time: %.3fs (%s statements)' % (
+            self.sql_time, len(self.statements)))
+        write()
+
+        repeated = self.repeated_statements()
+        if repeated:
+            write('Repeated statements (possible N+1 queries)')
+            write('------------------------------------------')
+            for shape, count, total in repeated:
+                write('%sx, %.3fs: %s' % (count, total, shape))
+            dotted = sorted(
+                name for name in self._field_names(fields) if '.' in name)
+            if dotted:
+                write()
+                write('Dotted fields were requested: %s' % ', '.join(dotted))
+                write('Each one is loaded lazily for every row unless the '
+                      'relationship is eager loaded.')
+            write()
+
+        write('SQL statements')
+        write('--------------')
+        for i, (statement, duration) in enumerate(self.statements):
+            write('[%s] %.3fs: %s' % (i, duration, _space_re.sub(' ', statement)))
+        write()
+
+        write('Profile')
+        write('-------')
+        stats = pstats.Stats(self.profile, stream=out)
+        stats.sort_stats('cumulative').print_stats(stats_limit)
+        return out.getvalue()
+
+    def _field_names(self, fields):
+        if isinstance(fields, dict):
+            fields = list(fields.keys())
+        names = []
+        for item in (fields or []):
+            if isinstance(item, dict):
+                item = item.get('name', '')
+            names.append(item.lstrip('+-'))
+        return names
+
+    def write_report(self, directory, name, title=None, fields=None):
+        """Write profile and report to ``directory``.
+
+        Two files are written: ``name``.prof, which can be loaded with
+        :mod:`pstats` (or any tool that understands its format), and
+        ``name``.txt, which contains the report from :meth:`get_report`.
+
+        Returns the path to the report.
+
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        base_path = os.path.join(directory, name)
+        self.profile.dump_stats(base_path + '.prof')
+        report_path = base_path + '.txt'
+        with open(report_path, 'w') as fp:
+            fp.write(self.get_report(title=title, fields=fields))
+        return report_path
@@ -0,0 +1,246 @@
+"""Precomputed snapshots of rendered responses.
+
+A :class:`Snapshot` is a rendered response body stored in a file. Requests
+are served directly from the file--using the WSGI server's `file_wrapper`
+when available or a memory map otherwise--so no database or serialization
+work is done per request.
+
+Snapshots are rebuilt in a background thread and swapped in atomically (the
+new body is written to a temporary file that's then renamed over the old
+one). Requests being served from the old file when that happens aren't
+affected.
+
+Snapshot files are shared by all the processes using the same directory.
+A process that changes the underlying data calls :func:`mark_changed`, which
+sets the modification time of a marker file to the current time, and each
+snapshot file's modification time is set to the time its build started. A
+snapshot is stale when the marker is at least as new as the snapshot, which
+every process checks before serving it.
+
+"""
+import logging
+import mmap
+import os
+import tempfile
+import threading
+import time
+
+
+log = logging.getLogger(__name__)
+
+BLOCK_SIZE = 64 * 1024
+
+_snapshots = {}
+_snapshots_lock = threading.Lock()
+
+
+def get_snapshot(directory, name):
+    """Get the :class:`Snapshot` named ``name`` in ``directory``."""
+    path = os.path.join(directory, '{0}.snapshot'.format(name))
+    try:
+        return _snapshots[path]
+    except KeyError:
+        with _snapshots_lock:
+            if path not in _snapshots:
+                _snapshots[path] = Snapshot(path, name)
+            return _snapshots[path]
+
+
+def discard_snapshot(snapshot):
+    """Forget ``snapshot`` if it hasn't been built (by this process)."""
+    with _snapshots_lock:
+        if not snapshot.exists and snapshot.context is None:
+            _snapshots.pop(snapshot.path, None)
+
+
+def mark_changed(directory, prefix):
+    """Mark snapshots with names starting with ``prefix`` as out of date."""
+    path = _get_marker_path(directory, prefix)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    open(path, 'a').close()
+    # Use the same clock as build start times (the file system's may be
+    # coarser)
+    now = time.time()
+    os.utime(path, (now, now))
+
+
+def get_changed_at(directory, prefix):
+    """Get time of last :func:`mark_changed` call (or `None`)."""
+    try:
+        return os.stat(_get_marker_path(directory, prefix)).st_mtime
+    except OSError:
+        return None
+
+
+def _get_marker_path(directory, prefix):
+    return os.path.join(directory, '{0}.changed'.format(prefix))
+
+
+def find_snapshots(directory, prefix):
+    """Find existing snapshots in ``directory`` with names like ``prefix``."""
+    return [
+        s for s in list(_snapshots.values())
+        if os.path.dirname(s.path) == directory and s.name.startswith(prefix)]
+
+
+class Snapshot(object):
+
+    def __init__(self, path, name=None):
+        self.path = path
+        self.name = name
+        self.context = None
+        """Arbitrary data needed to rebuild the snapshot."""
+        self.content_type = None
+        self.built_at = None
+        """When the build of the snapshot file started."""
+        self.size = None
+        self.stale = False
+        self._map = None
+        self._lock = threading.Lock()
+        self._building = False
+        self._rebuild_pending = False
+
+    @property
+    def exists(self):
+        """Whether the snapshot has been built (by this process)."""
+        return self.built_at is not None
+
+    @property
+    def building(self):
+        """Whether a rebuild is in progress (in this process)."""
+        return self._building
+
+    def is_stale(self, max_age=None, changed_at=None):
+        """Whether the snapshot should be rebuilt.
+
+        ``changed_at`` is the time the underlying data last changed (see
+        :func:`get_changed_at`).
+
+        """
+        if self.stale or self.built_at is None:
+            return True
+        if changed_at is not None and changed_at >= self.built_at:
+            return True
+        return max_age is not None and time.time() - self.built_at > max_age
+
+    def write(self, body, content_type, built_at=None):
+        """Atomically replace the snapshot's content with ``body``.
+
+        ``built_at`` is when the build of ``body`` started (now by default).
+
+        """
+        if built_at is None:
+            built_at = time.time()
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.snapshot-')
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(body)
+            os.utime(temp_path, (built_at, built_at))
+            os.rename(temp_path, self.path)
+        except Exception:
+            os.remove(temp_path)
+            raise
+        with self._lock:
+            self.content_type = content_type
+            self.stale = False
+        self.refresh()
+        log.debug('Wrote snapshot %s (%s bytes)' % (self.path, len(body)))
+
+    def remove(self):
+        """Remove the snapshot's file (in all processes)."""
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+        self._clear()
+        log.debug('Removed snapshot %s' % self.path)
+
+    def _clear(self):
+        with self._lock:
+            self._map = None
+            self.size = None
+            self.built_at = None
+            self.stale = False
+
+    def refresh(self):
+        """Pick up the snapshot file if it was replaced by another process.
+
+        If it was removed, the snapshot no longer exists.
+
+        """
+        try:
+            fp = open(self.path, 'rb')
+        except (IOError, OSError):
+            self._clear()
+            return
+        with fp:
+            stat = os.fstat(fp.fileno())
+            if stat.st_mtime == self.built_at and stat.st_size == self.size:
+                return
+            new_map = None
+            if stat.st_size:
+                # Zero-length files can't be mapped
+                new_map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        with self._lock:
+            # Readers iterating over the old map keep a reference to it
+            self._map = new_map
+            self.size = stat.st_size
+            self.built_at = stat.st_mtime
+
+    def serve(self, environ):
+        """Return WSGI app iter for the snapshot's content."""
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        if file_wrapper is not None:
+            # The file is opened now, so a concurrent swap won't affect us
+            try:
+                return file_wrapper(open(self.path, 'rb'), BLOCK_SIZE)
+            except (IOError, OSError):
+                # Removed since it was last refreshed
+                pass
+        return self._iter_map(self._map)
+
+    def _iter_map(self, map):
+        if map is None:
+            return
+        for i in range(0, len(map), BLOCK_SIZE):
+            yield map[i:i + BLOCK_SIZE]
+
+    def rebuild(self, build):
+        """Rebuild snapshot in a background thread.
+
+        ``build`` is called with no args and must return the body and its
+        content type, or `None` if there's nothing to snapshot, in which
+        case the snapshot is removed. If a rebuild is already in progress,
+        another rebuild will be done when it finishes (so changes made during
+        a rebuild aren't lost), but no more than one.
+
+        """
+        with self._lock:
+            if self._building:
+                self._rebuild_pending = True
+                return
+            self._building = True
+        thread = threading.Thread(target=self._rebuild, args=(build,))
+        thread.daemon = True
+        thread.start()
+
+    def _rebuild(self, build):
+        while True:
+            try:
+                built_at = time.time()
+                result = build()
+                if result is None:
+                    self.remove()
+                else:
+                    self.write(result[0], result[1], built_at)
+            except Exception:
+                log.exception('Could not rebuild snapshot %s' % self.path)
+            with self._lock:
+                if not self._rebuild_pending:
+                    self._building = False
+                    return
+                self._rebuild_pending = False
@@ -0,0 +1,231 @@
+"""Support for incremental (delta) sync of collections.
+
+Clients that keep a local copy of a collection pass the token they got from
+their previous sync in the `changed_since` param and get back only the
+members that were created or updated since then, the IDs of members that
+were deleted since then, and a new token.
+
+Changes are detected using a column declared by the entity class via its
+`sync_column` attribute. Whenever a row is created or updated, this column
+must be set to a value greater than that of every other row in the table.
+Rows whose sync column is NULL aren't synced.
+
+The values must also become visible (i.e., be committed) in increasing
+order. A client that has synced up to value N never looks at values below N
+again, so a row that's committed with a value below N after that sync is
+never synced. Wall-clock timestamps and plain sequences don't guarantee
+this: with concurrent transactions, the one that gets the lower value can
+commit last. A per-row version number that's incremented on each change
+won't work either: a row going from version 1 to 2 would be missed by a
+client that has already seen another row at version 5.
+
+The safe way to assign values is with a counter table created by
+:func:`make_sync_counter_table`. :func:`next_sync_value` increments the
+collection's counter, which locks its row until the transaction ends, so
+transactions that change the collection get their values and commit one
+after another. When `Resource.sync_counter_table` is set, `create` and
+`update` set the sync column this way, and `delete` takes the lock before
+recording a tombstone, which makes tombstone IDs safe too. Code that
+changes the collection outside of Restler (including `bulk_import`, which
+leaves the sync column as is) has to do the same.
+
+Members are synced in (sync column, primary key) order and the token records
+the position of the last member returned, so rows that share a sync column
+value (e.g., rows changed together in one transaction) aren't skipped when a
+sync is split across several requests by a limit.
+
+Deletes are recorded as "tombstones" in a table created by
+:func:`make_tombstone_table`.
+
+"""
+import base64
+import datetime
+import decimal
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from sqlalchemy import (
+    BigInteger, Column, DateTime, Integer, String, Table, and_, func, or_)
+from sqlalchemy.exc import IntegrityError
+
+
+INITIAL_TOKEN = '0'
+"""Token clients use for their first sync."""
+
+_datetime_formats = ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S')
+
+
+def make_tombstone_table(metadata, name='restler_tombstones'):
+    """Create tombstone table in ``metadata``.
+
+    Each row records the deletion of a member of a collection. The table
+    is shared by all collections.
+
+    """
+    return Table(
+        name, metadata,
+        Column('id', Integer, primary_key=True),
+        Column('collection', String(255), nullable=False, index=True),
+        Column('member_id', String(255), nullable=False),
+        Column('deleted_at', DateTime, nullable=False,
+               default=datetime.datetime.utcnow),
+    )
+
+
+def make_sync_counter_table(metadata, name='restler_sync_counters'):
+    """Create sync counter table in ``metadata``.
+
+    Each row holds the last sync column value assigned for a collection (see
+    :func:`next_sync_value`). The table is shared by all collections.
+
+    """
+    return Table(
+        name, metadata,
+        Column('collection', String(255), primary_key=True),
+        Column('value', BigInteger, nullable=False),
+    )
+
+
+def next_sync_value(session, table, collection):
+    """Get next sync column value for ``collection``.
+
+    The collection's counter is incremented in ``session``'s current
+    transaction, which keeps its row locked until the transaction ends.
+    Other transactions getting a value for the same collection wait for
+    that, so values are committed in the order they're assigned.
+
+    """
+    counter = table.c.collection == collection
+    update = table.update().where(counter).values(value=table.c.value + 1)
+    if not session.execute(update).rowcount:
+        # First value for the collection
+        try:
+            with session.begin_nested():
+                session.execute(
+                    table.insert().values(collection=collection, value=1))
+        except IntegrityError:
+            # Inserted concurrently
+            session.execute(update)
+    q = session.query(table.c.value).filter(counter)
+    return q.scalar()
+
+
+def record_tombstone(session, table, collection, member_id):
+    """Record deletion of member in ``session``'s current transaction."""
+    session.execute(
+        table.insert().values(collection=collection, member_id=member_id))
+
+
+def get_tombstones(session, table, collection, since_id):
+    """Get tombstones for ``collection`` recorded after ``since_id``.
+
+    Returns a list of member IDs (as strings) and the ID of the latest
+    tombstone (which is ``since_id`` if there are no new tombstones).
+
+    Tombstone IDs are only committed in increasing order when tombstones
+    are recorded after taking the collection's counter lock (see
+    :func:`next_sync_value`); otherwise, a delete that commits late can be
+    missed.
+
+    """
+    q = session.query(table.c.id, table.c.member_id)
+    q = q.filter(table.c.collection == collection)
+    q = q.filter(table.c.id > since_id)
+    member_ids = []
+    for id, member_id in q.order_by(table.c.id):
+        since_id = id
+        member_ids.append(member_id)
+    return member_ids, since_id
+
+
+def get_latest_tombstone_id(session, table, collection):
+    q = session.query(func.max(table.c.id))
+    q = q.filter(table.c.collection == collection)
+    return q.scalar() or 0
+
+
+def after_key(columns, key):
+    """Return criterion for rows that come after ``key``.
+
+    Rows are ordered by ``columns`` (e.g., the sync column followed by the
+    primary key columns) and ``key`` holds the values of ``columns`` for
+    the last row seen. This is the row value comparison ``(columns) >
+    (key)``, expanded so it works with any database.
+
+    """
+    clauses = []
+    for i, column in enumerate(columns):
+        equal = [c == v for (c, v) in zip(columns[:i], key[:i])]
+        clauses.append(and_(*(equal + [column > key[i]])))
+    return or_(*clauses)
+
+
+def encode_token(key, tombstone_id):
+    """Encode ``key`` and ``tombstone_id`` as a token.
+
+    ``key`` is the sync column value and primary key values of the last
+    member synced (as a tuple), or `None` if no members have been synced.
+    The token is opaque to clients; it's URL-safe so it can be passed as-is
+    in a query string.
+
+    """
+    data = dict(d=tombstone_id)
+    if key is not None:
+        data['k'], data['t'] = zip(*[_encode_value(v) for v in key])
+    token = base64.urlsafe_b64encode(json.dumps(data).encode('utf-8'))
+    return token.decode('ascii').rstrip('=')
+
+
+def decode_token(token):
+    """Decode ``token`` and return the key and tombstone ID.
+
+    For the initial token, the key is `None` and the tombstone ID is 0.
+    Raises `ValueError` if ``token`` isn't a valid token.
+
+    """
+    if token == INITIAL_TOKEN:
+        return None, 0
+    try:
+        token = str(token)
+        token += '=' * (-len(token) % 4)
+        data = json.loads(base64.urlsafe_b64decode(token).decode('utf-8'))
+        tombstone_id = int(data['d'])
+        key = None
+        if 'k' in data:
+            if len(data['k']) != len(data['t']) or not data['k']:
+                raise ValueError(data)
+            key = tuple(
+                _decode_value(v, t) for (v, t) in zip(data['k'], data['t']))
+    except (TypeError, ValueError, KeyError, UnicodeError):
+        raise ValueError('Invalid sync token: %r' % token)
+    return key, tombstone_id
+
+
+def _encode_value(value):
+    """Return JSON-compatible version of ``value`` and its type."""
+    if isinstance(value, datetime.datetime):
+        return value.strftime(_datetime_formats[0]), 'datetime'
+    elif isinstance(value, datetime.date):
+        return value.isoformat(), 'date'
+    elif isinstance(value, decimal.Decimal):
+        return str(value), 'decimal'
+    return value, None
+
+
+def _decode_value(value, type_):
+    if type_ == 'datetime':
+        for fmt in _datetime_formats:
+            try:
+                return datetime.datetime.strptime(value, fmt)
+            except ValueError:
+                pass
+        raise ValueError(value)
+    elif type_ == 'date':
+        return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+    elif type_ == 'decimal':
+        return decimal.Decimal(value)
+    elif type_ is not None:
+        raise ValueError(type_)
+    return value
@@ -1,3 +1,14 @@
+import datetime
+import decimal
+import io
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
 import unittest
 
 import pylons
@@ -6,7 +17,29 @@ from routes.util import URLGenerator
 from webob import Request
 from webob.exc import HTTPSeeOther
 
-from restler import Controller, Entity
+from sqlalchemy import (
+    Boolean, Column, Date, ForeignKey, Integer, MetaData, Numeric, String,
+    Table, create_engine, event, text)
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import relationship, scoped_session, sessionmaker
+from sqlalchemy.pool import QueuePool, SingletonThreadPool, StaticPool
+
+from restler import Controller, Entity, instrument_class
+from restler import embed, msgpack_ext
+from restler.bulk import BulkImport, iter_lines
+from restler.coalesce import CoalesceTimeout, SingleFlight
+from restler.core import Resource, ResourceApp, _flights, route
+from restler.pool import get_pool_metrics, metrics_app, prewarm
+from restler.profiler import RequestProfiler, statement_shape
+from restler.snapshot import (
+    Snapshot, find_snapshots, get_changed_at, mark_changed)
+from restler.sync import (
+    INITIAL_TOKEN, decode_token, encode_token, get_latest_tombstone_id,
+    get_tombstones, make_sync_counter_table, make_tombstone_table,
+    next_sync_value, record_tombstone)
+from restler.tests import loadtest
+from restler.timeout import (
+    StatementTimeout, StatementTimeoutError, _unsupported_dialects)
 
 
 class Fields_for_Simple_Object(unittest.TestCase):
@@ -97,3 +130,1076 @@ class TestRedirection(unittest.TestCase):
 
 class TestController(unittest.TestCase):
     pass
+
+
+class TestSingleFlight(unittest.TestCase):
+
+    def setUp(self):
+        self.flights = SingleFlight()
+        self.calls = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def _slow(self, result='result'):
+        self.calls.append(1)
+        self.started.set()
+        self.release.wait(5)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def _run_concurrently(self, func, count=5, timeout=None):
+        results = []
+        def target():
+            try:
+                results.append(self.flights.do('key', func, timeout))
+            except Exception as e:
+                results.append(e)
+        leader = threading.Thread(target=target)
+        leader.start()
+        self.started.wait(5)
+        threads = [threading.Thread(target=target) for i in range(count - 1)]
+        for t in threads:
+            t.start()
+        while self.flights._calls['key'].waiters < count - 1:
+            time.sleep(0.001)
+        self.release.set()
+        for t in [leader] + threads:
+            t.join(5)
+        return results
+
+    def test_identical_calls_are_coalesced(self):
+        results = self._run_concurrently(self._slow)
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(sorted(results), [('result', False)] + [('result', True)] * 4)
+        self.assertEqual(self.flights.in_flight(), 0)
+
+    def test_errors_are_propagated_to_waiters(self):
+        error = ValueError('nope')
+        results = self._run_concurrently(lambda: self._slow(error))
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(results, [error] * 5)
+
+    def test_waiter_times_out(self):
+        # Simulate a call that's in flight and never finishes
+        self.flights._calls['key'] = type(
+            'Call', (object,), dict(event=threading.Event(), waiters=0))()
+        self.assertRaises(
+            CoalesceTimeout, self.flights.do, 'key', self._slow, 0.01)
+        self.assertEqual(self.calls, [])
+
+    def test_sequential_calls_are_not_coalesced(self):
+        self.release.set()
+        self.assertEqual(self.flights.do('key', self._slow), ('result', False))
+        self.assertEqual(self.flights.do('key', self._slow), ('result', False))
+        self.assertEqual(len(self.calls), 2)
+
+
+class TestCoalescedResource(unittest.TestCase):
+
+    def setUp(self):
+        Base = declarative_base()
+        class Thing(Base, Entity):
+            __tablename__ = 'things'
+            id = Column(Integer, primary_key=True)
+        instrument_class(Thing)
+        engine = create_engine(
+            'sqlite://', poolclass=StaticPool,
+            connect_args=dict(check_same_thread=False))
+        Base.metadata.create_all(engine)
+        self.session = scoped_session(sessionmaker(bind=engine))
+        self.session.add(Thing())
+        self.session.commit()
+        self.started = threading.Event()
+        self.release = threading.Event()
+        session, started, release = self.session, self.started, self.release
+        class ThingResource(Resource):
+            entity = Thing
+            coalesce = True
+            coalesce_headers = Resource.coalesce_headers + ('X-Thing',)
+            def get_db_session(self):
+                return session
+            def set_collection(self, *args, **kwargs):
+                started.set()
+                release.wait(5)
+                self.response.headers['X-Thing'] = 'leader'
+                self.response.set_cookie('session', 'leader')
+                super(ThingResource, self).set_collection(*args, **kwargs)
+        self.app = ResourceApp(ThingResource)
+
+    def test_waiters_get_leader_headers(self):
+        responses = []
+        def target():
+            responses.append(Request.blank('/things').get_response(self.app))
+        leader = threading.Thread(target=target)
+        leader.start()
+        self.started.wait(5)
+        waiter = threading.Thread(target=target)
+        waiter.start()
+        while not _flights.in_flight() or not any(
+                c.waiters for c in _flights._calls.values()):
+            time.sleep(0.001)
+        self.release.set()
+        leader.join(5)
+        waiter.join(5)
+        self.assertEqual(len(responses), 2)
+        for response in responses:
+            self.assertEqual(response.status_int, 200)
+            self.assertEqual(response.headers.get('X-Thing'), 'leader')
+            self.assertEqual(response.content_type, 'application/json')
+            self.assertEqual(response.content_length, len(response.body))
+        # Cookies set by the leader aren't shared
+        self.assertEqual(
+            len([r for r in responses if 'Set-Cookie' in r.headers]), 1)
+
+class TestRequestProfiler(unittest.TestCase):
+
+    def test_statement_shape(self):
+        self.assertEqual(
+            statement_shape("SELECT a FROM t\nWHERE id = 12 AND x IN (?, ?)"),
+            "SELECT a FROM t WHERE id = ? AND x IN (?)")
+        self.assertEqual(
+            statement_shape("SELECT * FROM t1 WHERE name = 'it''s'"),
+            "SELECT * FROM t1 WHERE name = ?")
+
+    def test_repeated_statements_are_flagged(self):
+        engine = create_engine('sqlite://')
+        profiler = RequestProfiler(engines=[engine], repeat_threshold=3)
+        profiler.start()
+        with engine.connect() as conn:
+            for i in range(3):
+                conn.execute(text('SELECT %s' % i))
+            conn.execute(text("SELECT 'x', 1"))
+        profiler.stop()
+        self.assertEqual(len(profiler.statements), 4)
+        repeated = profiler.repeated_statements()
+        self.assertEqual([r[:2] for r in repeated], [('SELECT ?', 3)])
+        report = profiler.get_report(fields=['*', 'owner.name'])
+        assert 'Dotted fields were requested: owner.name' in report
+
+
+    def test_only_one_profiler_at_a_time(self):
+        first, second = RequestProfiler(), RequestProfiler()
+        self.assertTrue(first.start())
+        try:
+            self.assertFalse(second.start())
+            second.stop()  # A no-op
+        finally:
+            first.stop()
+        self.assertTrue(second.start())
+        second.stop()
+
+    def test_profiler_errors_do_not_fail_requests(self):
+        Base = declarative_base()
+        class Thing(Base, Entity):
+            __tablename__ = 'things'
+            id = Column(Integer, primary_key=True)
+        instrument_class(Thing)
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        session = scoped_session(sessionmaker(bind=engine))
+        session.add(Thing())
+        session.commit()
+        class Profile(object):
+            def enable(self):
+                raise ValueError('Another profiling tool is already active')
+        class ThingResource(Resource):
+            entity = Thing
+            profile_dir = tempfile.gettempdir()
+            profile_sample_rate = 1
+            def get_db_session(self):
+                return session
+            def _get_profiler(self):
+                profiler = super(ThingResource, self)._get_profiler()
+                profiler.profile = Profile()
+                return profiler
+        response = Request.blank('/things').get_response(
+            ResourceApp(ThingResource))
+        self.assertEqual(response.status_int, 200)
+        # The lock was released
+        profiler = RequestProfiler()
+        self.assertTrue(profiler.start())
+        profiler.stop()
+
+    def test_reports_are_not_overwritten(self):
+        Base = declarative_base()
+        class Thing(Base, Entity):
+            __tablename__ = 'things'
+            id = Column(Integer, primary_key=True)
+        instrument_class(Thing)
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        session = scoped_session(sessionmaker(bind=engine))
+        session.add(Thing())
+        session.commit()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        class ThingResource(Resource):
+            entity = Thing
+            profile_dir = directory
+            profile_sample_rate = 1
+            def get_db_session(self):
+                return session
+        app = ResourceApp(ThingResource)
+        for i in range(2):
+            self.assertEqual(
+                Request.blank('/things').get_response(app).status_int, 200)
+        self.assertEqual(len(os.listdir(directory)), 4)
+
+class TestPool(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = create_engine(
+            'sqlite://', poolclass=QueuePool, pool_size=2,
+            connect_args=dict(check_same_thread=False))
+
+    def test_prewarm_is_capped_at_pool_size(self):
+        metrics = get_pool_metrics(self.engine)
+        self.assertEqual(prewarm(self.engine, 5), 2)
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot['checked_in'], 2)
+        self.assertEqual(snapshot['checked_out'], 0)
+        self.assertEqual(snapshot['connects'], 2)
+
+    def test_checkouts_are_timed(self):
+        metrics = get_pool_metrics(self.engine)
+        conn = self.engine.connect()
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot['checked_out'], 1)
+        self.assertEqual(snapshot['checkouts'], 1)
+        self.assertEqual(snapshot['checkout_latency_ms'][-1], (None, 1))
+        conn.close()
+
+    def test_unpooled_engines_are_not_prewarmed(self):
+        for poolclass in (SingletonThreadPool, StaticPool):
+            engine = create_engine('sqlite://', poolclass=poolclass)
+            self.assertEqual(prewarm(engine, 5), 0)
+
+    def test_size_attribute(self):
+        engine = create_engine(
+            'sqlite://', poolclass=SingletonThreadPool, pool_size=3)
+        self.assertEqual(get_pool_metrics(engine).snapshot()['size'], 3)
+
+    def test_metrics_app_format(self):
+        get_pool_metrics(self.engine)
+        response = Request.blank('/?x=1&format=json').get_response(metrics_app)
+        self.assertEqual(response.content_type, 'application/json')
+        self.assertTrue(isinstance(json.loads(response.text), list))
+        for query in ('', '?format=jsonp', '?x=format=json'):
+            response = Request.blank('/' + query).get_response(metrics_app)
+            self.assertEqual(response.content_type, 'text/plain')
+
+
+class TestSync(unittest.TestCase):
+
+    def test_token_round_trip(self):
+        values = (
+            None, 42, 'abc', decimal.Decimal('1.50'),
+            datetime.date(2011, 3, 1),
+            datetime.datetime(2011, 3, 1, 12, 30, 15),
+            datetime.datetime(2011, 3, 1, 12, 30, 15, 123),
+        )
+        for value in values:
+            key = (value, 3, 'x')
+            self.assertEqual(decode_token(encode_token(key, 7)), (key, 7))
+        self.assertEqual(decode_token(encode_token(None, 7)), (None, 7))
+
+    def test_initial_token(self):
+        self.assertEqual(decode_token(INITIAL_TOKEN), (None, 0))
+
+    def test_invalid_token(self):
+        self.assertRaises(ValueError, decode_token, 'not a token')
+        self.assertRaises(
+            ValueError, decode_token, encode_token((1, 1), 1)[:-2])
+
+    def _make_resource(self, use_counter=False):
+        Base = declarative_base()
+        class Thing(Base, Entity):
+            __tablename__ = 'things'
+            sync_column = 'seq'
+            id = Column(Integer, primary_key=True)
+            seq = Column(Integer)
+        instrument_class(Thing)
+        counter_table = tombstone_table = None
+        if use_counter:
+            counter_table = make_sync_counter_table(Base.metadata)
+            tombstone_table = make_tombstone_table(Base.metadata)
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        self.session = scoped_session(sessionmaker(bind=engine))
+        session = self.session
+        class ThingResource(Resource):
+            entity = Thing
+            sync_counter_table = counter_table
+            def get_db_session(self):
+                return session
+        ThingResource.tombstone_table = tombstone_table
+        self.addCleanup(session.remove)
+        return Thing, ResourceApp(ThingResource)
+
+    def _sync(self, app, token, limit):
+        path = '/things?changed_since=%s&limit=%s' % (token, limit)
+        response = Request.blank(path).get_response(app)
+        self.assertEqual(response.status_int, 200)
+        obj = json.loads(response.body.decode('utf-8'))['response']
+        return [m['id'] for m in obj['results']], obj['sync']['token']
+
+    def test_sync_is_split_by_limit_without_skipping_ties(self):
+        Thing, app = self._make_resource()
+        # Rows 1-3 were changed together; row 4 has never been synced
+        for id, seq in ((1, 5), (2, 5), (3, 5), (4, None), (5, 6)):
+            self.session.add(Thing(id=id, seq=seq))
+        self.session.commit()
+        ids, token = self._sync(app, INITIAL_TOKEN, 2)
+        self.assertEqual(ids, [1, 2])
+        ids, token = self._sync(app, token, 2)
+        self.assertEqual(ids, [3, 5])
+        ids, token = self._sync(app, token, 2)
+        self.assertEqual(ids, [])
+        self.session.query(Thing).filter_by(id=4).update(dict(seq=7))
+        self.session.commit()
+        ids, next_token = self._sync(app, token, 2)
+        self.assertEqual(ids, [4])
+
+    def test_tombstones(self):
+        engine = create_engine('sqlite://')
+        metadata = MetaData()
+        table = make_tombstone_table(metadata)
+        metadata.create_all(engine)
+        session = sessionmaker(bind=engine)()
+        self.assertEqual(get_latest_tombstone_id(session, table, 'things'), 0)
+        record_tombstone(session, table, 'things', '1')
+        record_tombstone(session, table, 'others', '2')
+        record_tombstone(session, table, 'things', '3')
+        session.commit()
+        self.assertEqual(
+            get_tombstones(session, table, 'things', 0), (['1', '3'], 3))
+        self.assertEqual(get_tombstones(session, table, 'things', 1), (['3'], 3))
+        self.assertEqual(get_tombstones(session, table, 'things', 3), ([], 3))
+        self.assertEqual(get_latest_tombstone_id(session, table, 'things'), 3)
+
+    def test_next_sync_value(self):
+        engine = create_engine('sqlite://')
+        metadata = MetaData()
+        table = make_sync_counter_table(metadata)
+        metadata.create_all(engine)
+        session = sessionmaker(bind=engine)()
+        self.assertEqual(next_sync_value(session, table, 'things'), 1)
+        self.assertEqual(next_sync_value(session, table, 'things'), 2)
+        self.assertEqual(next_sync_value(session, table, 'others'), 1)
+        session.rollback()
+        self.assertEqual(next_sync_value(session, table, 'things'), 1)
+
+    def test_sync_counter_table(self):
+        Thing, app = self._make_resource(use_counter=True)
+        def request(path, method='GET'):
+            return Request.blank(path, method=method).get_response(app)
+        for i in range(3):
+            self.assertEqual(request('/things', 'POST').status_int, 303)
+        self.assertEqual(
+            [t.seq for t in self.session.query(Thing).order_by(Thing.id)],
+            [1, 2, 3])
+        self.session.remove()
+        ids, token = self._sync(app, INITIAL_TOKEN, 10)
+        self.assertEqual(ids, [1, 2, 3])
+        self.assertEqual(request('/things/1', 'PUT').status_int, 303)
+        self.assertEqual(request('/things/2', 'DELETE').status_int, 303)
+        self.session.remove()
+        response = Request.blank(
+            '/things?changed_since=%s' % token).get_response(app)
+        obj = json.loads(response.body.decode('utf-8'))['response']
+        self.assertEqual([m['id'] for m in obj['results']], [1])
+        self.assertEqual(obj['sync']['deleted'], ['2'])
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.snapshot = Snapshot('%s/things.json.snapshot' % self.dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_write_and_serve(self):
+        self.assertFalse(self.snapshot.exists)
+        self.snapshot.write(b'[1, 2, 3]', 'application/json')
+        self.assertTrue(self.snapshot.exists)
+        self.assertEqual(b''.join(self.snapshot.serve({})), b'[1, 2, 3]')
+        self.assertEqual(self.snapshot.content_type, 'application/json')
+
+    def test_serve_with_file_wrapper(self):
+        self.snapshot.write(b'[1, 2, 3]', 'application/json')
+        environ = {'wsgi.file_wrapper': lambda fp, size: fp}
+        fp = self.snapshot.serve(environ)
+        self.assertEqual(fp.read(), b'[1, 2, 3]')
+        fp.close()
+
+    def test_swap_does_not_affect_in_progress_responses(self):
+        self.snapshot.write(b'old', 'text/plain')
+        app_iter = self.snapshot.serve({})
+        self.snapshot.write(b'new', 'text/plain')
+        self.assertEqual(b''.join(app_iter), b'old')
+        self.assertEqual(b''.join(self.snapshot.serve({})), b'new')
+
+    def test_rebuild(self):
+        self.snapshot.write(b'old', 'text/plain')
+        self.snapshot.stale = True
+        self.assertTrue(self.snapshot.is_stale())
+        built = threading.Event()
+        def build():
+            built.set()
+            return b'new', 'text/plain'
+        self.snapshot.rebuild(build)
+        built.wait(5)
+        while self.snapshot._building:
+            time.sleep(0.001)
+        self.assertFalse(self.snapshot.is_stale())
+        self.assertEqual(b''.join(self.snapshot.serve({})), b'new')
+
+    def test_changes_in_other_processes(self):
+        self.assertEqual(get_changed_at(self.dir, 'things'), None)
+        self.snapshot.write(b'old', 'text/plain')
+        self.assertFalse(self.snapshot.is_stale(
+            changed_at=get_changed_at(self.dir, 'things')))
+        # Another process changes the data...
+        mark_changed(self.dir, 'things')
+        self.assertTrue(self.snapshot.is_stale(
+            changed_at=get_changed_at(self.dir, 'things')))
+        # ...and rebuilds the snapshot
+        other = Snapshot(self.snapshot.path)
+        other.write(b'new', 'text/plain')
+        self.snapshot.refresh()
+        self.assertFalse(self.snapshot.is_stale(
+            changed_at=get_changed_at(self.dir, 'things')))
+        self.assertEqual(b''.join(self.snapshot.serve({})), b'new')
+
+    def test_emptied_collection(self):
+        Base = declarative_base()
+        class Thing(Base, Entity):
+            __tablename__ = 'things'
+            id = Column(Integer, primary_key=True)
+        instrument_class(Thing)
+        engine = create_engine(
+            'sqlite://', poolclass=StaticPool,
+            connect_args=dict(check_same_thread=False))
+        Base.metadata.create_all(engine)
+        session = scoped_session(sessionmaker(bind=engine))
+        self.addCleanup(session.remove)
+        session.add(Thing())
+        session.commit()
+        directory = self.dir
+        class ThingResource(Resource):
+            entity = Thing
+            snapshot_dir = directory
+            snapshot_origins = ['http://localhost']
+            def get_db_session(self):
+                return session
+        app = ResourceApp(ThingResource)
+        get = lambda path, **kwargs: Request.blank(
+            path, **kwargs).get_response(app)
+        self.assertEqual(get('/things').status_int, 200)
+        self.assertEqual(get('/things/1', method='DELETE').status_int, 303)
+        for snapshot in find_snapshots(directory, ''):
+            while snapshot.building:
+                time.sleep(0.001)
+            self.assertFalse(os.path.exists(snapshot.path))
+        self.assertEqual(get('/things').status_int, 404)
+
+    def test_snapshots_are_per_origin(self):
+        Base = declarative_base()
+        class Thing(Base, Entity):
+            __tablename__ = 'things'
+            id = Column(Integer, primary_key=True)
+        instrument_class(Thing)
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        session = scoped_session(sessionmaker(bind=engine))
+        self.addCleanup(session.remove)
+        session.add(Thing())
+        session.commit()
+        directory = self.dir
+        class ThingResource(Resource):
+            entity = Thing
+            snapshot_dir = directory
+            snapshot_origins = ['http://a.example.com', 'http://b.example.com']
+            def get_db_session(self):
+                return session
+        app = ResourceApp(ThingResource)
+        hosts = ('a.example.com', 'b.example.com', 'a.example.com', 'c.com')
+        for host in hosts:
+            request = Request.blank('/things')
+            request.host = host
+            response = request.get_response(app)
+            obj = json.loads(response.body.decode('utf-8'))['response']
+            self.assertEqual(
+                obj['request']['full_url'], 'http://%s/things' % host)
+        # No snapshots for other origins or failed requests
+        request = Request.blank('/things.x')
+        request.host = 'a.example.com'
+        self.assertEqual(request.get_response(app).status_int, 406)
+        self.assertEqual(len(find_snapshots(directory, '')), 2)
+
+
+class TestMessagePack(unittest.TestCase):
+
+    def setUp(self):
+        self.obj = dict(
+            a=datetime.datetime(2011, 3, 1, 12, 30, 15, 123),
+            b=datetime.date(2011, 3, 1),
+            c=datetime.time(12, 30),
+            d=decimal.Decimal('1.50'),
+            e=[1, 'x', None],
+        )
+
+    def test_round_trip(self):
+        packed = msgpack_ext.packb(self.obj)
+        self.assertEqual(msgpack_ext.unpackb(packed), self.obj)
+
+    def test_utc_offset_is_kept(self):
+        tzinfo = msgpack_ext._UTCOffset(datetime.timedelta(hours=-5))
+        values = (
+            datetime.datetime(2011, 3, 1, 12, 30, 15, 123, tzinfo=tzinfo),
+            datetime.time(12, 30, tzinfo=tzinfo),
+        )
+        for value in values:
+            unpacked = msgpack_ext.unpackb(msgpack_ext.packb(value))
+            self.assertEqual(unpacked, value)
+            self.assertEqual(unpacked.utcoffset(), value.utcoffset())
+        # Fallback for Python < 3.7
+        parsed = msgpack_ext._strptime(
+            values[0].isoformat(), msgpack_ext._datetime_formats)
+        self.assertEqual(parsed, values[0])
+        self.assertEqual(parsed.utcoffset(), datetime.timedelta(hours=-5))
+
+    def test_simplify_object_native(self):
+        self.assertEqual(
+            Entity.simplify_object(list(self.obj.values()), native=True),
+            list(self.obj.values()))
+        self.assertEqual(
+            Entity.simplify_object([self.obj['b'], self.obj['d']]),
+            ['2011-03-01', 1.5])
+
+    def test_chunks_form_one_document(self):
+        packer = msgpack_ext.make_packer()
+        chunks = [packer.pack_array_header(2)]
+        chunks += [packer.pack(self.obj), packer.pack(self.obj)]
+        self.assertEqual(
+            msgpack_ext.unpackb(b''.join(chunks)), [self.obj, self.obj])
+
+
+class TestStatementTimeout(unittest.TestCase):
+
+    def setUp(self):
+        self.session = sessionmaker(bind=create_engine('sqlite://'))()
+
+    def tearDown(self):
+        self.session.close()
+
+    def test_slow_statement_is_cancelled(self):
+        # Counts up forever
+        q = text(
+            'WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c) '
+            'SELECT max(x) FROM c')
+        def run():
+            with StatementTimeout(self.session, 0.1):
+                self.session.execute(q).fetchall()
+        self.assertRaises(StatementTimeoutError, run)
+
+    def test_fast_statement_is_not_cancelled(self):
+        with StatementTimeout(self.session, 1) as timeout:
+            self.assertEqual(self.session.execute(text('SELECT 1')).scalar(), 1)
+        self.assertFalse(timeout.expired)
+
+    def test_timer_firing_after_exit_does_nothing(self):
+        with StatementTimeout(self.session, 60) as timeout:
+            self.session.execute(text('SELECT 1'))
+        # As if the timer fired just as the statement finished
+        timeout._timer.function()
+        self.assertFalse(timeout.expired)
+        self.assertEqual(self.session.execute(text('SELECT 1')).scalar(), 1)
+
+    def test_unsupported_dialect_warns_once(self):
+        class Connection(object):
+            # A DBAPI connection without interrupt or cancel
+            def __init__(self):
+                self._conn = sqlite3.connect(':memory:')
+            def __getattr__(self, name):
+                if name in ('interrupt', 'cancel'):
+                    raise AttributeError(name)
+                return getattr(self._conn, name)
+        engine = create_engine('sqlite://', creator=Connection)
+        session = sessionmaker(bind=engine)()
+        self.addCleanup(session.close)
+        _unsupported_dialects.discard('sqlite')
+        self.addCleanup(_unsupported_dialects.discard, 'sqlite')
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        logger = logging.getLogger('restler.timeout')
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+        for i in range(2):
+            with StatementTimeout(session, 1):
+                session.execute(text('SELECT 1'))
+        self.assertEqual(len(records), 1)
+
+
+class TestBulkImport(unittest.TestCase):
+
+    def setUp(self):
+        Base = declarative_base()
+        class Thing(Base, Entity):
+            __tablename__ = 'things'
+            id = Column(Integer, primary_key=True)
+            name = Column('thing_name', String(50), nullable=False)
+        self.Thing = Thing
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        self.session = sessionmaker(bind=engine)()
+
+    def tearDown(self):
+        self.session.close()
+
+    def test_iter_lines(self):
+        fp = io.BytesIO(b'a\r\nbb\n\nccc')
+        self.assertEqual(
+            list(iter_lines(fp, block_size=2)), [b'a', b'bb', b'', b'ccc'])
+
+    def test_iter_lines_with_max_line_length(self):
+        fp = io.BytesIO(b'a\n' + b'x' * 10 + b'\nbb\nyyyy\n' + b'z' * 10)
+        self.assertEqual(
+            list(iter_lines(fp, block_size=3, max_line_length=3)),
+            [b'a', None, b'bb', None, None])
+
+    def test_import(self):
+        fp = io.BytesIO(b'\n'.join([
+            b'{"name": "a"}',
+            b'',
+            b'{"name": "b"}',
+            b'{"name": ',
+            b'{"color": "red"}',
+            b'{"id": 1, "name": "duplicate"}',
+            b'{"name": "c"}',
+        ]))
+        reports = []
+        importer = BulkImport(
+            self.session, self.Thing, chunk_size=2, progress=reports.append)
+        report = importer.run(fp)
+        self.assertEqual(report['lines'], 7)
+        self.assertEqual(report['imported'], 3)
+        self.assertEqual(report['failed'], 3)
+        self.assertEqual([e['line'] for e in report['errors']], [4, 5, 6])
+        self.assertEqual(len(reports), report['chunks'])
+        names = [name for (name,) in self.session.query(self.Thing.name)]
+        self.assertEqual(sorted(names), ['a', 'b', 'c'])
+
+    def test_line_errors(self):
+        def convert(name, val):
+            # Raises InvalidOperation for "x"
+            return int(decimal.Decimal(val)) if name == 'id' else val
+        fp = io.BytesIO(b'\n'.join([
+            b'{"name": "' + b'x' * 100 + b'"}',
+            b'{"id": "x"}',
+            b'{"id": "1", "name": "a"}',
+        ]))
+        importer = BulkImport(
+            self.session, self.Thing, convert=convert, max_line_length=50)
+        report = importer.run(fp)
+        self.assertEqual(report['imported'], 1)
+        self.assertEqual([e['line'] for e in report['errors']], [1, 2])
+
+    def test_errors_are_capped(self):
+        fp = io.BytesIO(b'x\n' * 5)
+        importer = BulkImport(self.session, self.Thing, max_errors=2)
+        report = importer.run(fp)
+        self.assertEqual(report['failed'], 5)
+        self.assertEqual(len(report['errors']), 2)
+        self.assertTrue(report['errors_truncated'])
+
+
+class TestRoute(unittest.TestCase):
+
+    def _route(self, path, method='GET', **kwargs):
+        request = Request.blank(path, method=method, **kwargs)
+        return route(request, 'things', {'bulk_import': 'POST'})
+
+    def test_collection(self):
+        self.assertEqual(self._route('/things'), ('index', None, None))
+        self.assertEqual(self._route('/x/things.json'), ('index', None, 'json'))
+        self.assertEqual(
+            self._route('/things', 'POST'), ('create', None, None))
+        self.assertEqual(self._route('/things/new'), ('new', None, None))
+        self.assertEqual(
+            self._route('/things/bulk_import', 'POST'),
+            ('bulk_import', None, None))
+
+    def test_member(self):
+        self.assertEqual(self._route('/things/1.json'), ('show', '1', 'json'))
+        self.assertEqual(self._route('/things/1', 'PUT'), ('update', '1', None))
+        self.assertEqual(
+            self._route('/things/1', 'DELETE'), ('delete', '1', None))
+        self.assertEqual(self._route('/things/1/edit'), ('edit', '1', None))
+        self.assertEqual(
+            self._route('/things/1', 'POST', POST={'_method': 'DELETE'}),
+            ('delete', '1', None))
+
+    def test_no_match(self):
+        self.assertEqual(self._route('/stuff'), None)
+        self.assertEqual(self._route('/things/1', 'POST'), None)
+        self.assertEqual(self._route('/things/1/edit', 'PUT'), None)
+
+
+class TestResource(unittest.TestCase):
+
+    def setUp(self):
+        Base = declarative_base()
+        class Thing(Base, Entity):
+            __tablename__ = 'things'
+            id = Column(Integer, primary_key=True)
+            name = Column(String(50))
+        instrument_class(Thing)
+        self.Thing = Thing
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        self.session = scoped_session(sessionmaker(bind=engine))
+        session = self.session
+        class ThingResource(Resource):
+            entity = Thing
+            def get_db_session(self):
+                return session
+        self.app = ResourceApp(ThingResource)
+
+    def tearDown(self):
+        self.session.remove()
+
+    def _request(self, path, **kwargs):
+        request = Request.blank(path, **kwargs)
+        request.script_name = '/script'
+        return request.get_response(self.app)
+
+    def test_create_show_update_delete(self):
+        response = self._request('/things', method='POST', POST={'name': 'x'})
+        self.assertEqual(response.status_int, 303)
+        self.assertTrue(response.location.endswith('/script/things/1.json'))
+        response = self._request('/things/1.json?wrap=false')
+        self.assertEqual(response.content_type, 'application/json')
+        member = json.loads(response.body.decode('utf-8'))[0]
+        self.assertEqual(member['name'], 'x')
+        self.assertEqual(member['__path__'], '/script/things/1')
+        response = self._request(
+            '/things/1', method='POST', POST={'_method': 'PUT', 'name': 'y'})
+        self.assertEqual(response.status_int, 303)
+        self.assertEqual(self.session.query(self.Thing).get(1).name, 'y')
+        response = self._request('/things/1', method='DELETE')
+        self.assertTrue(response.location.endswith('/script/things.json'))
+        self.assertEqual(self._request('/things/1').status_int, 404)
+
+    def test_index(self):
+        for name in ('a', 'b', 'c'):
+            self._request('/things', method='POST', POST={'name': name})
+        response = self._request('/things?limit=2&order_by=name')
+        obj = json.loads(response.body.decode('utf-8'))['response']
+        self.assertEqual(obj['result_count'], 2)
+        self.assertEqual([m['name'] for m in obj['results']], ['a', 'b'])
+        self.assertEqual(obj['request']['collection_path'], '/script/things')
+
+    def test_legacy_simplify_overrides(self):
+        # Overrides written before the native arg was added
+        Thing = self.Thing
+        def to_simple_object(self, fields=None):
+            return Entity.to_simple_object(self, fields)
+        def to_simple_collection(cls, collection, fields=None):
+            return Entity.to_simple_collection.__func__(cls, collection, fields)
+        Thing.to_simple_object = to_simple_object
+        Thing.to_simple_collection = classmethod(to_simple_collection)
+        self._request('/things', method='POST', POST={'name': 'x'})
+        for path in ('/things.json', '/things/1.json'):
+            response = self._request(path + '?wrap=false')
+            self.assertEqual(response.status_int, 200)
+            member = json.loads(response.body.decode('utf-8'))[0]
+            self.assertEqual(member['name'], 'x')
+
+    def test_invalid_limit_and_offset(self):
+        self._request('/things', method='POST', POST={'name': 'x'})
+        for query in ('limit=-1', 'limit=x', 'offset=-1', 'offset=x'):
+            self.assertEqual(self._request('/things?' + query).status_int, 400)
+        self.assertEqual(self._request('/things?offset=0').status_int, 200)
+
+    def test_max_response_size(self):
+        self._request('/things', method='POST', POST={'name': 'x' * 100})
+        resource_class = self.app.resource_classes[0]
+        resource_class.max_response_size = 100
+        try:
+            for format in ('json', 'msgpack'):
+                response = self._request('/things.%s' % format)
+                self.assertEqual(response.status_int, 400)
+        finally:
+            del resource_class.max_response_size
+
+    def test_unknown_path_and_format(self):
+        self.assertEqual(self._request('/stuff').status_int, 404)
+        self._request('/things', method='POST', POST={'name': 'x'})
+        self.assertEqual(self._request('/things/1.html').status_int, 406)
+
+
+class TestIdsToStr(unittest.TestCase):
+
+    def setUp(self):
+        Base = declarative_base()
+        class Thing(Base, Entity):
+            __tablename__ = 'things'
+            id = Column(Integer, primary_key=True)
+        class Named(Base, Entity):
+            __tablename__ = 'named'
+            name = Column(String(50), primary_key=True)
+        class Pair(Base, Entity):
+            __tablename__ = 'pairs'
+            a = Column(Integer, primary_key=True)
+            b = Column(String(50), primary_key=True)
+        class Dated(Base, Entity):
+            __tablename__ = 'dated'
+            day = Column(Date, primary_key=True)
+            amount = Column(Numeric(10, 2), primary_key=True)
+        class Slugged(Base, Entity):
+            __tablename__ = 'slugged'
+            id = Column(Integer, primary_key=True)
+            @property
+            def id_str(self):
+                return 'slug-{0}'.format(self.id)
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        self.session = sessionmaker(bind=engine)()
+        self.session.add_all([
+            Thing(id=1), Thing(id=2),
+            Named(name='a'), Named(name='b"c'),
+            Pair(a=1, b='x'), Pair(a=2, b='y'),
+            Dated(day=datetime.date(2010, 1, 2), amount=decimal.Decimal('1.5')),
+            Slugged(id=1),
+        ])
+        self.session.commit()
+        self.entities = Thing, Named, Pair, Dated, Slugged
+
+    def tearDown(self):
+        self.session.close()
+
+    def test_same_as_id_str(self):
+        for entity in self.entities:
+            members = self.session.query(entity).all()
+            self.assertEqual(
+                entity.ids_to_str(members), [m.id_str for m in members])
+
+    def test_composite_keys(self):
+        Pair = self.entities[2]
+        members = self.session.query(Pair).order_by(Pair.a).all()
+        self.assertEqual(Pair.ids_to_str(members), ['[1, "x"]', '[2, "y"]'])
+
+    def test_transient_members(self):
+        Thing = self.entities[0]
+        self.assertEqual(Thing.ids_to_str([Thing()]), ['null'])
+
+    def test_member_paths_with_non_string_ids(self):
+        Slugged = self.entities[4]
+        Slugged.id_str = property(lambda self: self.id)
+        instrument_class(Slugged)
+        session = scoped_session(sessionmaker(bind=self.session.bind))
+        self.addCleanup(session.remove)
+        class SluggedResource(Resource):
+            entity = Slugged
+            def get_db_session(self):
+                return session
+        path = '/%s?wrap=false' % Slugged.collection_name
+        response = Request.blank(path).get_response(
+            ResourceApp(SluggedResource))
+        members = json.loads(response.body.decode('utf-8'))
+        self.assertEqual(
+            [m['__path__'] for m in members],
+            ['/%s/1' % Slugged.collection_name])
+
+
+class TestEmbed(unittest.TestCase):
+
+    def setUp(self):
+        Base = declarative_base()
+        route_tags = Table(
+            'route_tags', Base.metadata,
+            Column('route_id', Integer, ForeignKey('routes.id')),
+            Column('tag_id', Integer, ForeignKey('tags.id')))
+        class Route(Base, Entity):
+            __tablename__ = 'routes'
+            id = Column(Integer, primary_key=True)
+            name = Column(String(50))
+            stops = relationship('Stop', order_by='Stop.seq')
+            active_stops = relationship(
+                'Stop', order_by='Stop.seq', viewonly=True,
+                primaryjoin='and_(Route.id == Stop.route_id, Stop.active)')
+            tags = relationship('Tag', secondary=route_tags)
+        class Stop(Base, Entity):
+            __tablename__ = 'stops'
+            id = Column(Integer, primary_key=True)
+            route_id = Column(Integer, ForeignKey('routes.id'))
+            seq = Column(Integer)
+            name = Column(String(50))
+            active = Column(Boolean, default=True)
+            route = relationship(Route)
+            times = relationship('Time')
+        class Time(Base, Entity):
+            __tablename__ = 'times'
+            id = Column(Integer, primary_key=True)
+            stop_id = Column(Integer, ForeignKey('stops.id'))
+        class Tag(Base, Entity):
+            __tablename__ = 'tags'
+            id = Column(Integer, primary_key=True)
+            name = Column(String(50))
+        for cls in (Route, Stop, Time, Tag):
+            instrument_class(cls)
+        self.Route = Route
+        self.engine = create_engine('sqlite://')
+        Base.metadata.create_all(self.engine)
+        self.session = scoped_session(sessionmaker(bind=self.engine))
+        express, local = Tag(name='express'), Tag(name='local')
+        for i in range(3):
+            stops = [
+                Stop(seq=(3 - j), name='{0}-{1}'.format(i, j),
+                     active=(j != 2), times=[Time(), Time()])
+                for j in range(3)]
+            tags = [express, local] if i else [local]
+            self.session.add(Route(name=str(i), stops=stops, tags=tags))
+        self.session.commit()
+        session = self.session
+        class RouteResource(Resource):
+            entity = Route
+            max_embed_limit = 10
+            def get_db_session(self):
+                return session
+        class StopResource(Resource):
+            entity = Stop
+            def get_db_session(self):
+                return session
+        self.app = ResourceApp(RouteResource, StopResource)
+
+    def tearDown(self):
+        self.session.remove()
+
+    def _get(self, path, embed):
+        request = Request.blank(path)
+        request.GET.update(wrap='false', embed=embed)
+        statements = []
+        def count(*args):
+            statements.append(args)
+        event.listen(self.engine, 'before_cursor_execute', count)
+        try:
+            response = request.get_response(self.app)
+        finally:
+            event.remove(self.engine, 'before_cursor_execute', count)
+        if response.status_int != 200:
+            return response.status_int, None, len(statements)
+        return 200, json.loads(response.body.decode('utf-8')), len(statements)
+
+    def test_one_to_many(self):
+        status, routes, count = self._get(
+            '/routes', '[{"name": "stops", "limit": 2, "fields": ["name"]}]')
+        self.assertEqual(len(routes), 3)
+        self.assertEqual(
+            [s['name'] for s in routes[0]['stops']], ['0-2', '0-1'])
+        self.assertNotIn('id', routes[0]['stops'][0])
+        # One for the routes and one for all the stops
+        self.assertEqual(count, 2)
+
+    def test_many_to_one_and_nested(self):
+        status, stops, count = self._get(
+            '/stops', '["route", "times", "route.tags"]')
+        self.assertEqual(len(stops), 9)
+        self.assertEqual(stops[0]['route']['name'], '0')
+        self.assertEqual(len(stops[0]['times']), 2)
+        self.assertEqual(
+            sorted(t['name'] for t in stops[-1]['route']['tags']),
+            ['express', 'local'])
+        self.assertEqual(count, 4)
+
+    def test_many_to_many(self):
+        status, routes, count = self._get('/routes', '["tags"]')
+        self.assertEqual([len(r['tags']) for r in routes], [1, 2, 2])
+        self.assertEqual(count, 2)
+
+    def test_invalid(self):
+        self.assertEqual(self._get('/routes', '["nope"]')[0], 400)
+        self.assertEqual(self._get('/routes', '["name"]')[0], 400)
+        self.assertEqual(self._get('/routes', '["stops.times.x"]')[0], 400)
+        self.assertEqual(
+            self._get('/routes', '[{"name": "stops", "limit": 11}]')[0], 400)
+        self.assertEqual(
+            self._get('/routes', '[{"name": "stops", "limit": -1}]')[0], 400)
+        self.assertEqual(self._get('/routes', '[')[0], 400)
+
+    def test_custom_join_condition(self):
+        status, routes, count = self._get('/routes', '["active_stops"]')
+        self.assertEqual(
+            [s['name'] for s in routes[0]['active_stops']], ['0-1', '0-0'])
+
+    def test_limit_without_window_functions(self):
+        supports_window_functions = embed.supports_window_functions
+        embed.supports_window_functions = lambda dialect: False
+        try:
+            status, routes, count = self._get(
+                '/routes', '[{"name": "stops", "limit": 2}]')
+        finally:
+            embed.supports_window_functions = supports_window_functions
+        self.assertEqual(
+            [[s['name'] for s in r['stops']] for r in routes],
+            [['0-2', '0-1'], ['1-2', '1-1'], ['2-2', '2-1']])
+
+
+class TestLoadTest(unittest.TestCase):
+
+    def test_parse_mix(self):
+        self.assertEqual(
+            loadtest.parse_mix('index=40, show=60'),
+            [('index', 40.0), ('show', 60.0)])
+        self.assertRaises(ValueError, loadtest.parse_mix, 'nope=1')
+        self.assertRaises(ValueError, loadtest.parse_mix, 'index')
+
+    def test_percentile(self):
+        values = list(range(1, 11))
+        self.assertEqual(loadtest.percentile(values, 50), 5)
+        self.assertEqual(loadtest.percentile(values, 99), 10)
+        self.assertEqual(loadtest.percentile(values, 0), 1)
+        self.assertEqual(loadtest.percentile([], 50), None)
+
+    def test_find_regressions(self):
+        baseline = dict(requests_per_second=100, p50=10, p95=20, p99=None)
+        stats = dict(requests_per_second=95, p50=10.5, p95=25, p99=50)
+        self.assertEqual(
+            loadtest.find_regressions(stats, baseline, 10), ['p95'])
+        stats['requests_per_second'] = 80
+        self.assertEqual(
+            loadtest.find_regressions(stats, baseline, 10),
+            ['requests_per_second', 'p95'])
+
+    def test_ids_in_flight_are_not_deleted(self):
+        load_test = loadtest.LoadTest(None, [1], [('show', 1)])
+        self.assertEqual(load_test._reserve_id('show'), 1)
+        self.assertEqual(load_test._reserve_id('delete'), None)
+        load_test._release_id(1)
+        self.assertEqual(load_test._reserve_id('delete'), 1)
+        self.assertEqual(load_test._reserve_id('show'), None)
+        load_test._release_id(1)
+        self.assertEqual(load_test.ids, [])
+
+    def test_run(self):
+        fd, path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        try:
+            app, engine = loadtest.make_app('sqlite:///%s' % path)
+            ids = loadtest.seed(engine, 10)
+            load_test = loadtest.LoadTest(
+                app, ids, loadtest.parse_mix(loadtest.DEFAULT_MIX),
+                requests=20, concurrency=2, page_size=5)
+            stats = load_test.run()
+        finally:
+            loadtest.Session.remove()
+            os.remove(path)
+        self.assertEqual(stats['requests'], 20)
+        self.assertEqual(stats['errors'], 0)
+        self.assertEqual(
+            sum(a['requests'] for a in stats['actions'].values()), 20)
@@ -0,0 +1,408 @@
+"""Concurrent load test harness for the full Restler stack.
+
+A sample entity and controller are mounted in a Pylons WSGI app backed by
+a SQLite database (a temporary file by default). Requests are made directly
+against the WSGI app--no network is involved--from a pool of threads, using
+a configurable mix of actions.
+
+Run ``python -m restler.tests.loadtest --help`` for options. Typical usage::
+
+    # Record a baseline before upgrading something...
+    python -m restler.tests.loadtest --save-baseline baseline.json
+
+    # ...then compare against it afterwards
+    python -m restler.tests.loadtest --baseline baseline.json
+
+"""
+import json
+import math
+import optparse
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+
+from paste.registry import RegistryManager
+from pylons.configuration import PylonsConfig
+from pylons.wsgiapp import PylonsApp
+from routes.mapper import Mapper
+from routes.middleware import RoutesMiddleware
+from webob import Request
+
+from sqlalchemy import Column, Integer, String, create_engine
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+from restler import Controller, Entity, instrument_class
+
+
+ACTIONS = ('index', 'show', 'create', 'update', 'delete')
+
+DEFAULT_MIX = 'index=40,show=40,create=10,update=5,delete=5'
+
+Base = declarative_base()
+
+
+class Thing(Base, Entity):
+
+    __tablename__ = 'things'
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String(100))
+    value = Column(Integer)
+
+    @classmethod
+    def convert_param(cls, name, val):
+        if name in ('id', 'value'):
+            return int(val)
+        return val
+
+instrument_class(Thing)
+
+
+Session = scoped_session(sessionmaker())
+
+
+class ThingsController(Controller):
+
+    entity = Thing
+
+    def get_db_session(self):
+        return Session
+
+
+class LoadTestApp(PylonsApp):
+    """Pylons app that always dispatches to :class:`ThingsController`."""
+
+    def find_controller(self, controller):
+        return ThingsController
+
+
+def make_app(db_url):
+    connect_args = {}
+    if make_url(db_url).drivername.startswith('sqlite'):
+        # The connection is shared by worker threads, and writers may have to
+        # wait on each other
+        connect_args.update(check_same_thread=False, timeout=30)
+    engine = create_engine(db_url, connect_args=connect_args)
+    Base.metadata.create_all(engine)
+    Session.configure(bind=engine)
+    mapper = Mapper()
+    mapper.resource('thing', 'things')
+    config = PylonsConfig()
+    config.update({
+        'pylons.package': 'restler',
+        'pylons.paths': dict(root=None, controllers=None, templates=[]),
+        'pylons.h': None,
+        'pylons.app_globals': None,
+        'routes.map': mapper,
+    })
+    app = LoadTestApp(config=config)
+    app = RoutesMiddleware(app, mapper, singleton=False)
+    app = RegistryManager(app)
+    return app, engine
+
+
+def seed(engine, rows):
+    session = sessionmaker(bind=engine)()
+    session.add_all(
+        [Thing(name='thing %s' % i, value=i) for i in range(rows)])
+    session.commit()
+    ids = [id for (id,) in session.query(Thing.id)]
+    session.close()
+    return ids
+
+
+def parse_mix(mix):
+    """Parse "index=40,show=40,..." into a list of (action, weight)."""
+    weights = []
+    for item in mix.split(','):
+        action, weight = item.split('=')
+        action = action.strip()
+        if action not in ACTIONS:
+            raise ValueError('Unknown action: %s' % action)
+        weights.append((action, float(weight)))
+    return weights
+
+
+def percentile(values, p):
+    """Return the ``p``th percentile of sorted ``values`` (nearest rank)."""
+    if not values:
+        return None
+    rank = int(math.ceil(p / 100.0 * len(values)))
+    return values[max(0, min(rank, len(values)) - 1)]
+
+
+def peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on OS X and kilobytes on Linux
+    if sys.platform == 'darwin':
+        return rss / 1024.0 / 1024.0
+    return rss / 1024.0
+
+
+class LoadTest(object):
+
+    def __init__(self, app, ids, mix, requests=1000, concurrency=8,
+                 page_size=20):
+        self.app = app
+        self.ids = list(ids)
+        self.mix = mix
+        self.requests = requests
+        self.concurrency = concurrency
+        self.page_size = page_size
+        self.results = []
+        self._lock = threading.Lock()
+        self._remaining = requests
+        self._in_flight = {}
+        """Number of requests in flight for each ID."""
+
+    def choose_action(self):
+        total = sum(weight for action, weight in self.mix)
+        n = random.uniform(0, total)
+        for action, weight in self.mix:
+            n -= weight
+            if n <= 0:
+                break
+        return action
+
+    def _reserve_id(self, action):
+        """Pick an existing ID for ``action`` and mark it in flight.
+
+        Deletes only pick IDs with no requests in flight and remove them
+        right away, so a show or update never races a delete of the same
+        member (which would result in a spurious 404). Returns `None` if
+        there's no suitable ID.
+
+        """
+        with self._lock:
+            if action == 'delete':
+                ids = [i for i in self.ids if i not in self._in_flight]
+            else:
+                ids = self.ids
+            if not ids:
+                return None
+            id = random.choice(ids)
+            if action == 'delete':
+                self.ids.remove(id)
+            self._in_flight[id] = self._in_flight.get(id, 0) + 1
+            return id
+
+    def _release_id(self, id):
+        with self._lock:
+            self._in_flight[id] -= 1
+            if not self._in_flight[id]:
+                del self._in_flight[id]
+
+    def make_request(self, action, id=None):
+        """Return a :class:`webob.Request` for ``action``.
+
+        ``id`` is required for show, update, and delete.
+
+        """
+        if action == 'index':
+            offset = random.randrange(max(1, len(self.ids) - self.page_size))
+            return Request.blank('/things.json?offset=%s&limit=%s' % (
+                offset, self.page_size))
+        if action == 'create':
+            return Request.blank('/things.json', POST=dict(
+                name='new thing', value=str(random.randrange(1000))))
+        path = '/things/%s.json' % id
+        if action == 'show':
+            return Request.blank(path)
+        if action == 'update':
+            return Request.blank(path, POST=dict(
+                _method='PUT', value=str(random.randrange(1000))))
+        return Request.blank(path, POST=dict(_method='DELETE'))
+
+    def _worker(self):
+        while True:
+            with self._lock:
+                if self._remaining <= 0:
+                    return
+                self._remaining -= 1
+            action = self.choose_action()
+            id = None
+            if action in ('show', 'update', 'delete'):
+                id = self._reserve_id(action)
+                if id is None:
+                    continue
+            try:
+                req = self.make_request(action, id)
+                t0 = time.time()
+                res = req.get_response(self.app)
+                duration = time.time() - t0
+            finally:
+                if id is not None:
+                    self._release_id(id)
+            if action == 'create' and res.status_int == 303:
+                id = res.location.rsplit('/', 1)[-1].split('.')[0]
+                with self._lock:
+                    self.ids.append(int(id))
+            with self._lock:
+                self.results.append((action, duration, res.status_int))
+
+    def run(self):
+        threads = [threading.Thread(target=self._worker)
+                   for i in range(self.concurrency)]
+        t0 = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.elapsed = time.time() - t0
+        return self.get_stats()
+
+    def get_stats(self):
+        def summarize(results):
+            latencies = sorted(r[1] * 1000 for r in results)
+            return dict(
+                requests=len(results),
+                errors=len([r for r in results if r[2] >= 400]),
+                p50=percentile(latencies, 50),
+                p95=percentile(latencies, 95),
+                p99=percentile(latencies, 99),
+            )
+        stats = summarize(self.results)
+        stats.update(
+            concurrency=self.concurrency,
+            elapsed=self.elapsed,
+            requests_per_second=len(self.results) / self.elapsed,
+            peak_rss_mb=peak_rss_mb(),
+            actions=dict(
+                (action, summarize([r for r in self.results if r[0] == action]))
+                for action in ACTIONS),
+        )
+        return stats
+
+
+def format_stats(stats, baseline=None):
+    lines = []
+
+    def fmt(value, baseline_value=None):
+        if value is None:
+            return '-'
+        s = '%.2f' % value
+        if baseline_value:
+            s += ' (%+.1f%%)' % ((value - baseline_value) / baseline_value * 100)
+        return s
+
+    def get(d, *keys):
+        for key in keys:
+            if d is None:
+                return None
+            d = d.get(key)
+        return d
+
+    lines.append('Requests: %s in %.2fs with %s threads (%s errors)' % (
+        stats['requests'], stats['elapsed'], stats['concurrency'],
+        stats['errors']))
+    lines.append('Requests/second: %s' % fmt(
+        stats['requests_per_second'], get(baseline, 'requests_per_second')))
+    lines.append('Peak RSS (MB): %s' % fmt(
+        stats['peak_rss_mb'], get(baseline, 'peak_rss_mb')))
+    lines.append('')
+    lines.append('%-8s %8s %8s %22s %22s %22s' % (
+        'action', 'requests', 'errors', 'p50 (ms)', 'p95 (ms)', 'p99 (ms)'))
+    for action in ('all',) + ACTIONS:
+        if action == 'all':
+            s, b = stats, baseline
+        else:
+            s, b = stats['actions'][action], get(baseline, 'actions', action)
+        lines.append('%-8s %8s %8s %22s %22s %22s' % ((
+            action, s['requests'], s['errors']) + tuple(
+                fmt(s[p], get(b, p)) for p in ('p50', 'p95', 'p99'))))
+    return '\n'.join(lines)
+
+
+def find_regressions(stats, baseline, threshold):
+    """Return list of metrics that regressed by more than ``threshold``%."""
+    regressions = []
+    limit = threshold / 100.0
+    if stats['requests_per_second'] < (
+            baseline['requests_per_second'] * (1 - limit)):
+        regressions.append('requests_per_second')
+    for p in ('p50', 'p95', 'p99'):
+        if baseline.get(p) and stats[p] > baseline[p] * (1 + limit):
+            regressions.append(p)
+    return regressions
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(
+        usage='%prog [options]',
+        description='Load test the Restler stack (no network involved).')
+    parser.add_option(
+        '-n', '--requests', type='int', default=2000,
+        help='Total number of requests [%default]')
+    parser.add_option(
+        '-c', '--concurrency', type='int', default=8,
+        help='Number of threads making requests [%default]')
+    parser.add_option(
+        '-m', '--mix', default=DEFAULT_MIX,
+        help='Relative weights of actions [%default]')
+    parser.add_option(
+        '-r', '--rows', type='int', default=1000,
+        help='Number of rows to seed the database with [%default]')
+    parser.add_option(
+        '--page-size', type='int', default=20,
+        help='Limit for index requests [%default]')
+    parser.add_option(
+        '--db-url', default=None,
+        help='SQLAlchemy URL of database to use [a temporary SQLite file]')
+    parser.add_option(
+        '--baseline', default=None,
+        help='Compare results to baseline stored in this file')
+    parser.add_option(
+        '--save-baseline', default=None,
+        help='Store results as a baseline in this file')
+    parser.add_option(
+        '--max-regression', type='float', default=10,
+        help='Exit with an error if throughput or latency regressed by more '
+             'than this percentage relative to the baseline [%default]')
+    options, args = parser.parse_args(argv)
+
+    temp_path = None
+    db_url = options.db_url
+    if db_url is None:
+        fd, temp_path = tempfile.mkstemp(suffix='.db', prefix='restler-')
+        os.close(fd)
+        db_url = 'sqlite:///%s' % temp_path
+
+    try:
+        app, engine = make_app(db_url)
+        ids = seed(engine, options.rows)
+        load_test = LoadTest(
+            app, ids, parse_mix(options.mix), requests=options.requests,
+            concurrency=options.concurrency, page_size=options.page_size)
+        stats = load_test.run()
+    finally:
+        Session.remove()
+        if temp_path is not None:
+            os.remove(temp_path)
+
+    baseline = None
+    if options.baseline:
+        with open(options.baseline) as fp:
+            baseline = json.load(fp)
+    print(format_stats(stats, baseline))
+
+    if options.save_baseline:
+        with open(options.save_baseline, 'w') as fp:
+            json.dump(stats, fp, indent=2, sort_keys=True)
+
+    if baseline is not None:
+        regressions = find_regressions(stats, baseline, options.max_regression)
+        if regressions:
+            print('\nRegressed by more than %s%%: %s' % (
+                options.max_regression, ', '.join(regressions)))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,125 @@
+"""Statement timeouts.
+
+:class:`StatementTimeout` is a context manager that limits how long database
+statements executed within it can run. How that's done depends on the
+database:
+
+    - PostgreSQL: `SET LOCAL statement_timeout`, which applies until the end
+      of the current transaction.
+
+    - MySQL: The `max_execution_time` session variable (`max_statement_time`
+      for MariaDB), which is reset on exit. MySQL only applies it to
+      `SELECT` statements.
+
+    - Others: A timer that cancels whatever is running on the session's
+      connection when it fires, using the DBAPI connection's `interrupt`
+      (sqlite3) or `cancel` (psycopg2, cx_Oracle, etc) method. The timer is
+      disarmed on exit, and exiting waits for a cancel that's in progress,
+      so a cancel never hits a later statement. If the DBAPI connection has
+      neither method, a warning is logged (once per dialect) and statements
+      aren't limited.
+
+When a statement is cancelled, :class:`StatementTimeoutError` is raised.
+
+"""
+import logging
+import threading
+
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+
+
+log = logging.getLogger(__name__)
+
+QUERY_CANCELED = '57014'
+"""PostgreSQL error code for cancelled statements."""
+
+MYSQL_TIMEOUT_ERRORS = (3024, 1969)
+"""MySQL and MariaDB error codes for statements that took too long."""
+
+_unsupported_dialects = set()
+
+
+class StatementTimeoutError(Exception):
+    """Raised when a statement is cancelled because it took too long."""
+
+
+def _get_connection(session, mapper):
+    try:
+        return session.connection(mapper=mapper)
+    except TypeError:
+        # SQLAlchemy 2.0+
+        return session.connection(bind_arguments=dict(mapper=mapper))
+
+
+class StatementTimeout(object):
+
+    def __init__(self, session, seconds, mapper=None):
+        self.session = session
+        self.seconds = seconds
+        self.mapper = mapper
+        self.expired = False
+        self._timer = None
+        self._conn = None
+        self._reset = None
+        self._lock = threading.Lock()
+        self._finished = False
+
+    def __enter__(self):
+        conn = _get_connection(self.session, self.mapper)
+        if conn.dialect.name == 'postgresql':
+            conn.execute(text(
+                'SET LOCAL statement_timeout = %d' % (self.seconds * 1000)))
+            return self
+        if conn.dialect.name == 'mysql':
+            if getattr(conn.dialect, 'is_mariadb', False):
+                name, value = 'max_statement_time', self.seconds
+            else:
+                name, value = 'max_execution_time', int(self.seconds * 1000)
+            previous = conn.execute(
+                text('SELECT @@SESSION.%s' % name)).scalar()
+            conn.execute(text('SET SESSION %s = %s' % (name, value)))
+            self._conn = conn
+            self._reset = 'SET SESSION %s = %s' % (name, previous)
+            return self
+        dbapi_conn = conn.connection
+        cancel = (getattr(dbapi_conn, 'interrupt', None) or
+                  getattr(dbapi_conn, 'cancel', None))
+        if cancel is None:
+            if conn.dialect.name not in _unsupported_dialects:
+                _unsupported_dialects.add(conn.dialect.name)
+                log.warning(
+                    'Statement timeouts not supported for %s' %
+                    conn.dialect.name)
+            return self
+        def expire():
+            with self._lock:
+                # The statement may have finished just as the timer fired
+                if self._finished:
+                    return
+                self.expired = True
+                cancel()
+        self._timer = threading.Timer(self.seconds, expire)
+        self._timer.daemon = True
+        self._timer.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._timer is not None:
+            self._timer.cancel()
+            # Wait for a cancel that's already in progress, if any
+            with self._lock:
+                self._finished = True
+        if self._reset is not None:
+            try:
+                self._conn.execute(text(self._reset))
+            except Exception:
+                log.exception('Could not reset statement timeout')
+        if isinstance(exc_value, DBAPIError):
+            pgcode = getattr(exc_value.orig, 'pgcode', None)
+            args = getattr(exc_value.orig, 'args', None) or (None,)
+            if (self.expired or pgcode == QUERY_CANCELED or
+                    args[0] in MYSQL_TIMEOUT_ERRORS):
+                raise StatementTimeoutError(
+                    'Statement cancelled after {0}s'.format(self.seconds))
+        return False
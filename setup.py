@@ -39,7 +39,11 @@ Restler was originally extracted from the byCycle bicycle trip planner
     install_requires=(
         'decorator>=3.1.2',
         'SQLAlchemy>=0.6.0',
+        'WebOb>=1.2',
     ),
+    extras_require={
+        'msgpack': ['msgpack>=0.5.2'],
+    },
     test_suite = 'nose.collector',
 )
 